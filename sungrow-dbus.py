@@ -16,13 +16,41 @@ import argparse
 import logging
 import sys
 import os
+import struct
+import time
+import bisect
+import threading
+import configparser
+import mmap
+import signal
+import zlib
+import random
+import heapq
+import json
+import select
+import socket
+import termios
+import tty
+import array
+import math
+import operator
+import contextlib
+import cProfile
+import pstats
+import tracemalloc
+import multiprocessing
 import dbus
+import dbus.service
+from concurrent.futures import ThreadPoolExecutor, Future
+import collections
 # our own packages
 sys.path.insert(1, os.path.join(os.path.dirname(__file__), '../ext/velib_python'))
 sys.path.insert(1, '/opt/victronenergy')
 sys.path.insert(1, '/opt/victronenergy/dbus-mqtt/ext/velib_python/')
 from vedbus import VeDbusService
 from pymodbus.client.sync import ModbusTcpClient
+from pymodbus.pdu import ExceptionResponse, ModbusExceptions
+from pymodbus.register_read_message import ReadInputRegistersResponse, ReadHoldingRegistersResponse
 log = logging.getLogger(__name__)
 
 def twos_comp(val, bits=16):
@@ -39,11 +67,296 @@ def read(client, addr, n=1):
         reg = reg[0]
     return reg
 
+class DeviceError(IOError):
+    '''The device answered with a modbus exception, e.g. illegal address'''
+
+def read_block(client, block, unit=1):
+    '''
+    Read all the raw (unsigned) registers in a block in one transaction
+    '''
+    if block.kind == 'holding':
+        rr = client.read_holding_registers(block.start-1, block.count, unit=unit)
+    else:
+        rr = client.read_input_registers(block.start-1, block.count, unit=unit)
+    return _check(rr, block)
+
+def _check(rr, block):
+    if isinstance(rr, ExceptionResponse):
+        raise DeviceError(f'Error reading {block}: {rr}')
+    if rr.isError():
+        raise IOError(f'No response reading {block}: {rr}')
+    return rr.registers
+
+def read_blocks(client, blocks, unit=1):
+    '''
+    Read several blocks, pipelined if the client is a ModbusTransport that can.
+    Returns [(words, seconds it took)] in the same order.
+    '''
+    if isinstance(client, ModbusTransport):
+        results = client.read_many([(b.kind, b.start-1, b.count) for b in blocks], unit)
+        return [(_check(rr, b), seconds) for b, (rr, seconds) in zip(blocks, results)]
+
+    results = []
+    for block in blocks:
+        t0 = time.monotonic()
+        words = read_block(client, block, unit)
+        results.append((words, time.monotonic() - t0))
+    return results
+
+# Modbus transports
+TRANSPORTS = ('pymodbus', 'tcp', 'rtu-over-tcp', 'serial')
+MODBUS_TIMEOUT = 3 # seconds, same as pymodbus
+PIPELINE_WINDOW = 4 # requests in flight at once over modbus TCP
+SERIAL_BAUDRATE = 9600 # Sungrow's default for the RS485 port
+
+def crc16(data):
+    '''Modbus RTU CRC'''
+    crc = 0xffff
+    for b in data:
+        crc = (crc >> 8) ^ _CRC_TABLE[(crc ^ b) & 0xff]
+    return crc
+
+def _crc_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xa001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+_CRC_TABLE = _crc_table()
+
+class RegisterResponse:
+    '''What we hand back for a good read or write, like pymodbus' responses'''
+    def __init__(self, function_code, registers=()):
+        self.function_code = function_code
+        self.registers = list(registers)
+
+    def isError(self):
+        return False
+
+    def __repr__(self):
+        return f'RegisterResponse({self.function_code}, {self.registers})'
+
+class ModbusTransport:
+    '''
+    A small modbus master for the function codes we use, over a byte stream. It looks enough
+    like pymodbus' sync client to use in its place, and read_many() can have up to window
+    requests in flight at once, so a cycle of several blocks costs about one round trip rather
+    than one per block. Subclasses supply the stream (_open) and the framing.
+
+    Only frames with a transaction id (modbus TCP) can be pipelined. RTU replies aren't tagged,
+    so RTU transports always wait for each reply before sending the next request.
+
+    Failures raise IOError (socket.timeout is one) and leave the stream in an unknown state,
+    so the caller should close() it - the next request reconnects.
+    '''
+    pipelined = False
+
+    def __init__(self, timeout=MODBUS_TIMEOUT, window=1):
+        self.timeout = timeout
+        self.window = max(1, window) if self.pipelined else 1
+        self.socket = None
+        self._fd = None
+        self._buffer = b''
+
+    def connect(self):
+        if self._fd is None:
+            self._open()
+        return True
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+        elif self._fd is not None:
+            os.close(self._fd)
+        self.socket = self._fd = None
+        self._buffer = b''
+
+    def is_socket_open(self):
+        return self._fd is not None
+
+    def _send(self, data):
+        while data:
+            if not select.select([], [self._fd], [], self.timeout)[1]:
+                raise TimeoutError(f'Timed out sending to {self}')
+            data = data[os.write(self._fd, data) if self.socket is None else self.socket.send(data):]
+
+    def _recv(self, n, deadline):
+        while len(self._buffer) < n:
+            wait = deadline - time.monotonic()
+            if wait <= 0 or not select.select([self._fd], [], [], wait)[0]:
+                raise TimeoutError(f'Timed out waiting for {self}')
+            chunk = os.read(self._fd, 4096) if self.socket is None else self.socket.recv(4096)
+            if not chunk:
+                raise ConnectionError(f'{self} closed the connection')
+            self._buffer += chunk
+        data, self._buffer = self._buffer[:n], self._buffer[n:]
+        return data
+
+    def execute_many(self, requests):
+        '''
+        Send [(unit, pdu)] and return [(response pdu, seconds)] in the same order
+        '''
+        self.connect()
+        results = [None]*len(requests)
+        sent = {} # tid: (index, time sent)
+        queue = list(enumerate(requests))
+        while queue or sent:
+            while queue and len(sent) < self.window:
+                i, (unit, pdu) = queue.pop(0)
+                tid = self._next_tid()
+                self._send(self._frame(tid, unit, pdu))
+                sent[tid] = (i, time.monotonic())
+            tid, pdu = self._read_frame(time.monotonic() + self.timeout)
+            if tid not in sent:
+                log.debug('%s ignoring reply to %s', self, tid) # late reply to something we gave up on
+                continue
+            i, t0 = sent.pop(tid)
+            results[i] = (pdu, time.monotonic() - t0)
+        return results
+
+    def _next_tid(self):
+        return None
+
+    def _response(self, request_fc, pdu):
+        fc = pdu[0]
+        if fc == request_fc | 0x80:
+            return ExceptionResponse(request_fc, pdu[1])
+        if fc != request_fc:
+            raise IOError(f'{self} answered function {fc} to {request_fc}')
+        if fc in (3, 4):
+            return RegisterResponse(fc, struct.unpack(f'>{pdu[1]//2}H', pdu[2:2 + pdu[1]]))
+        return RegisterResponse(fc)
+
+    def read_many(self, reads, unit=1):
+        '''
+        [(kind, 0 based address, count)] to [(response, seconds)], pipelined if we can
+        '''
+        fcs = [3 if kind == 'holding' else 4 for kind, _, _ in reads]
+        requests = [(unit, struct.pack('>BHH', fc, address, count)) for fc, (_, address, count) in zip(fcs, reads)]
+        return [(self._response(fc, pdu), seconds) for fc, (pdu, seconds) in zip(fcs, self.execute_many(requests))]
+
+    def _execute(self, unit, pdu):
+        return self._response(pdu[0], self.execute_many([(unit, pdu)])[0][0])
+
+    def read_input_registers(self, address, count=1, unit=1):
+        return self._execute(unit, struct.pack('>BHH', 4, address, count))
+
+    def read_holding_registers(self, address, count=1, unit=1):
+        return self._execute(unit, struct.pack('>BHH', 3, address, count))
+
+    def write_register(self, address, value, unit=1):
+        return self._execute(unit, struct.pack('>BHH', 6, address, value))
+
+    def write_registers(self, address, values, unit=1):
+        return self._execute(unit, struct.pack(f'>BHHB{len(values)}H', 16, address, len(values), 2*len(values), *values))
+
+class _TcpStream:
+    def __init__(self, host, port=502, **kw):
+        super().__init__(**kw)
+        self.host = host
+        self.port = port
+
+    def _open(self):
+        self.socket = socket.create_connection((self.host, self.port), self.timeout)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._fd = self.socket.fileno()
+
+    def __str__(self):
+        return f'{type(self).__name__}({self.host}:{self.port})'
+
+class _RtuFraming:
+    # unit, function code, then the length depends on the function
+    def _frame(self, tid, unit, pdu):
+        frame = bytes([unit]) + pdu
+        return frame + struct.pack('<H', crc16(frame))
+
+    def _read_frame(self, deadline):
+        head = self._recv(3, deadline)
+        fc = head[1]
+        if fc & 0x80:
+            rest = 2
+        elif fc in (3, 4):
+            rest = head[2] + 2
+        else:
+            rest = 5
+        frame = head + self._recv(rest, deadline)
+        if crc16(frame[:-2]) != struct.unpack('<H', frame[-2:])[0]:
+            raise IOError(f'Bad CRC from {self}')
+        return None, frame[1:-2]
+
+class TcpTransport(_TcpStream, ModbusTransport):
+    '''Modbus TCP, with up to window requests in flight'''
+    pipelined = True
+    MBAP = struct.Struct('>HHHB') # transaction id, protocol 0, length, unit
+
+    def __init__(self, host, port=502, timeout=MODBUS_TIMEOUT, window=PIPELINE_WINDOW):
+        super().__init__(host, port, timeout=timeout, window=window)
+        self._tid = 0
+
+    def _next_tid(self):
+        self._tid = (self._tid + 1) & 0xffff
+        return self._tid
+
+    def _frame(self, tid, unit, pdu):
+        return self.MBAP.pack(tid, 0, len(pdu) + 1, unit) + pdu
+
+    def _read_frame(self, deadline):
+        tid, protocol, length, unit = self.MBAP.unpack(self._recv(self.MBAP.size, deadline))
+        if protocol != 0 or not 2 <= length <= 254:
+            raise IOError(f'Garbled MBAP header from {self}')
+        return tid, self._recv(length - 1, deadline)
+
+class RtuOverTcpTransport(_TcpStream, _RtuFraming, ModbusTransport):
+    '''RTU frames over a TCP socket, e.g. a serial to ethernet converter on the RS485 port'''
+
+class SerialTransport(_RtuFraming, ModbusTransport):
+    '''
+    RTU over a serial port (8N1), set up with termios so there's nothing more to install.
+    Works with a pty too, for testing.
+    '''
+    def __init__(self, device, baudrate=SERIAL_BAUDRATE, timeout=MODBUS_TIMEOUT):
+        super().__init__(timeout=timeout)
+        self.device = device
+        self.baudrate = baudrate
+
+    def _open(self):
+        fd = os.open(self.device, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        try:
+            tty.setraw(fd)
+            attrs = termios.tcgetattr(fd)
+            speed = getattr(termios, f'B{self.baudrate}')
+            attrs[2] = (attrs[2] & ~(termios.PARENB | termios.CSTOPB)) | termios.CLOCAL | termios.CREAD
+            attrs[4] = attrs[5] = speed
+            termios.tcsetattr(fd, termios.TCSANOW, attrs)
+            termios.tcflush(fd, termios.TCIOFLUSH)
+        except:
+            os.close(fd)
+            raise
+        self._fd = fd
+
+    def __str__(self):
+        return f'SerialTransport({self.device}@{self.baudrate})'
+
+def make_client(d):
+    '''The modbus client for a device's settings - see load_devices()'''
+    transport = d.get('transport', 'pymodbus')
+    if transport == 'tcp':
+        return TcpTransport(d['host'], d['port'], window=d.get('window', PIPELINE_WINDOW))
+    if transport == 'rtu-over-tcp':
+        return RtuOverTcpTransport(d['host'], d['port'])
+    if transport == 'serial':
+        return SerialTransport(d['host'], d.get('baudrate', SERIAL_BAUDRATE))
+    return ModbusTcpClient(d['host'], port=d['port'])
+
 
 def roundu(v, n, unit):
     '''
     Convert value to string with n significant digits and add unit string to the end
     '''
+    if v is None: # not on this model
+        return None
     v = round(v,n) #+ unit
     return v
 
@@ -54,183 +367,2521 @@ class SystemBus(dbus.bus.BusConnection):
         return dbus.bus.BusConnection.__new__(cls, dbus.bus.BusConnection.TYPE_SYSTEM)
     
 
+# Poll rate tiers - seconds between reads. static registers (identity etc.) are read once when
+# we connect and cached until we reconnect.
+TIERS = {
+    'fast': 1, # power, voltage, current
+    'slow': 30, # energy counters
+    'static': None,
+}
+
 class Reg:
-    def __init__(self, path, address):
-        pass
+    '''
+    A value on the device and the dbus path it's published on.
+    address is the address as given in the Sungrow modbus docs (i.e. 1 based, same as read())
+    width is the number of 16 bit registers, so width/signed gives U16, S16, U32 or S32.
+    text registers are UTF-8 strings of width registers (e.g. the serial number).
+    tier is how often it's polled - see TIERS
+    kind is 'input' or 'holding'. writeable holding registers can be set from the dbus.
+    '''
+    CODES = {(1, False): 'H', (1, True): 'h', (2, False): 'I', (2, True): 'i'}
+
+    def __init__(self, path, address, unit='', scale=1, width=1, signed=False, text=False, tier='fast',
+                 kind='input', writeable=False):
+        assert tier in TIERS, tier
+        assert not writeable or kind == 'holding', 'only holding registers are writeable'
+        self.kind = kind
+        self.writeable = writeable
+        self.path = path
+        self.address = address
+        self.unit = unit
+        self.scale = scale
+        self.width = width
+        self.signed = signed
+        self.text = text
+        self.tier = tier
+
+    @property
+    def end(self):
+        return self.address + self.width
+
+    @property
+    def code(self):
+        '''struct format character for this register'''
+        if self.text:
+            return f'{2*self.width}s'
+        return Reg.CODES[(self.width, self.signed)]
+
+    @property
+    def type(self):
+        if self.text:
+            return f'UTF8[{self.width}]'
+        return ('S' if self.signed else 'U') + str(16*self.width)
+
+    def encode(self, value):
+        '''
+        Raw register words for value - the opposite of decoding. Raises ValueError if it doesn't fit.
+        '''
+        v = int(round(value/self.scale))
+        bits = 16*self.width
+        low, high = (-(1 << bits - 1), (1 << bits - 1) - 1) if self.signed else (0, (1 << bits) - 1)
+        if not low <= v <= high:
+            raise ValueError(f'{value} is out of range for {self}')
+        v &= (1 << bits) - 1
+        if self.width == 1:
+            return [v]
+        words = [v & 0xffff, v >> 16]
+        return words if WORD_ORDER == 'little' else words[::-1]
+
+    def __repr__(self):
+        return f'Reg({self.path!r}, {self.address}, {self.type})'
+
+# Planner settings. Every modbus transaction to the WiNet dongle costs 30-80ms so it's much
+# cheaper to read a few registers we don't need than do another round trip.
+MAX_GAP = 16 # largest run of unused registers we'll read to join two blocks
+MAX_BLOCK = 64 # largest block we'll ask for in one go
+WORD_ORDER = 'little' # Sungrow puts the low word of 32 bit values first
+
+class Block:
+    '''
+    A run of contiguous registers read in one transaction, and the Regs that live in it.
+
+    The layout of the block is compiled into struct formats when it's planned, so decoding
+    is one pack of the raw words and one unpack per layout rather than work per register.
+    '''
+    def __init__(self, start, end, regs, word_order=WORD_ORDER):
+        self.start = start
+        self.count = end - start
+        self.regs = regs
+        self.kind = regs[0].kind
+        self._compile(word_order)
+
+    def _compile(self, word_order):
+        # Packing the words with the same endianness as the word order means each 32 bit pair
+        # comes out as a native struct 'I'/'i' in the right order
+        e = '<' if word_order == 'little' else '>'
+        self._words = struct.Struct(f'{e}{self.count}H')
+        self._swap_text = e == '<'
+
+        # Registers that are identical (e.g. the same value wanted by two products) share a field
+        fields = {}
+        for r in self.regs:
+            fields.setdefault((r.address, r.width, r.signed), []).append(r)
+
+        # Fields in one struct can't overlap, so anything that does goes in another layout
+        passes = []
+        for (address, width, signed), regs in sorted(fields.items()):
+            for p in passes:
+                if p[-1][0] + p[-1][1] <= address:
+                    break
+            else:
+                p = []
+                passes.append(p)
+            p.append((address, width, regs))
+
+        self._layouts = []
+        for p in passes:
+            fmt = e
+            pos = self.start
+            for address, width, regs in p:
+                if address > pos:
+                    fmt += f'{2*(address - pos)}x'
+                fmt += regs[0].code
+                pos = address + width
+            self._layouts.append((struct.Struct(fmt), [regs for _, _, regs in p]))
+
+    def decode(self, words):
+        '''
+        Returns {reg: value} for all the registers in this block
+        '''
+        buf = self._words.pack(*words)
+        values = {}
+        for layout, fields in self._layouts:
+            for v, regs in zip(layout.unpack_from(buf), fields):
+                if v.__class__ is bytes:
+                    v = self._text(v)
+                for r in regs:
+                    values[r] = v*r.scale
+
+        return values
+
+    def _text(self, b):
+        # Text is always high byte first in each register, whatever the word order
+        if self._swap_text:
+            b = bytearray(b)
+            b[0::2], b[1::2] = b[1::2], b[0::2]
+        return bytes(b).split(b'\0', 1)[0].decode('utf-8', 'replace').strip()
+
+    def __repr__(self):
+        return f'Block({self.kind} {self.start}, n={self.count}, {len(self.regs)} regs)'
+
+def plan_blocks(regs, max_gap=MAX_GAP, max_block=MAX_BLOCK, word_order=WORD_ORDER, capabilities=None):
+    '''
+    Merge registers into the fewest block reads, allowing gaps of up to max_gap unused registers
+    and no more than max_block registers per read. Input and holding registers are read separately.
+    With capabilities, registers the device doesn't answer are left out and gaps are only
+    bridged where every address in them answers.
+    '''
+    if capabilities is not None:
+        max_block = min(max_block, capabilities.max_block)
+        regs = [r for r in regs if capabilities.supports(r.kind, r.address, r.end)]
+
+    blocks = []
+    start = end = None
+    cur = []
+    for r in sorted(regs, key=lambda r: (r.kind, r.address)):
+        if cur and r.kind == cur[0].kind and r.address - end <= max_gap and max(end, r.end) - start <= max_block \
+                and (capabilities is None or capabilities.supports(r.kind, end, r.address)):
+            cur.append(r)
+            end = max(end, r.end)
+            continue
+
+        if cur:
+            blocks.append(Block(start, end, cur, word_order))
+        start, end, cur = r.address, r.end, [r]
+
+    if cur:
+        blocks.append(Block(start, end, cur, word_order))
+
+    return blocks
+
+# Default publishing deadbands by unit - (absolute, relative). Changes smaller than the larger
+# of the two aren't sent on the dbus until the path is MAX_AGE seconds stale.
+DEADBANDS = {
+    'W': (5, 0),
+    'V AC': (0.5, 0),
+    'A AC': (0.05, 0),
+}
+MAX_AGE = 60
+
+# Don't integrate power into energy across gaps longer than this (seconds) - e.g. when the
+# inverter was unreachable we've no idea what happened in between.
+MAX_INTEGRATION_DT = 60
+
+class Publisher:
+    '''
+    Sits in front of a VeDbusService and remembers the last value sent on each path, so we only
+    send ItemsChanged for values that have actually moved by more than the path's deadband.
+    Use it like the service: with publisher as s: s[path] = value - the values that get through
+    go in the service's context, so they're sent together in one ItemsChanged on the way out.
+    Nested withs share the outermost one's context, so a whole cycle goes in one ItemsChanged.
+    '''
+    def __init__(self, service, max_age=MAX_AGE):
+        self._service = service
+        self.max_age = max_age
+        self.deadbands = {} # path: (absolute, relative)
+        self._last = {} # path: (value, time sent)
+        self._now = 0
+        self.published = 0
+        self.suppressed = 0
+        self.samples = None # {path: value} of everything set, deadband or not, if wanted
+        self._contexts = [] # the service's context, once per with we're in
+
+    def set_deadband(self, path, absolute=0, relative=0):
+        self.deadbands[path] = (absolute, relative)
+
+    def forget(self, path):
+        '''Someone else has set the path, so we don't know what's on the dbus any more'''
+        self._last.pop(path, None)
+
+    def __enter__(self):
+        if self._contexts:
+            self._contexts.append(self._contexts[-1])
+        else:
+            self._now = time.monotonic()
+            self._contexts.append(self._service.__enter__())
+        return self
+
+    def __exit__(self, *exc):
+        self._contexts.pop()
+        if not self._contexts:
+            return self._service.__exit__(*exc)
+
+    def __getitem__(self, path):
+        return self._contexts[-1][path] if self._contexts else self._service[path]
+
+    def __setitem__(self, path, value):
+        if self.samples is not None:
+            self.samples[path] = value
+        last = self._last.get(path)
+        if last is not None:
+            v, t = last
+            if v == value:
+                return
+
+            db = self.deadbands.get(path)
+            if db is not None and self._now - t < self.max_age:
+                try:
+                    inside = abs(value - v) <= max(db[0], db[1]*abs(v))
+                except TypeError: # None, strings
+                    inside = False
+                if inside:
+                    self.suppressed += 1
+                    return
+
+        if self._contexts:
+            self._contexts[-1][path] = value
+        else:
+            self._service[path] = value
+        self._last[path] = (value, self._now)
+        self.published += 1
+
+# Diagnostics
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+PROFILE_DIR = '/tmp/sungrow-dbus' # RAM on Venus, so profiling doesn't wear the flash
+PROFILE_INTERVAL = 60 # seconds between profile dumps
+PROFILE_TOP = 25 # lines in each text dump
+TRACEMALLOC_FRAMES = 10
+
+class _Stage:
+    # Profiles one stage of a cycle. cProfile can only have one profiler running at once, so
+    # if another stage is being profiled on another thread this one just isn't.
+    __slots__ = ('diagnostics', 'profile')
+
+    def __init__(self, diagnostics, name):
+        self.diagnostics = diagnostics
+        self.profile = diagnostics._profiles.get(name)
+        if self.profile is None:
+            self.profile = diagnostics._profiles[name] = cProfile.Profile()
+
+    def __enter__(self):
+        if self.diagnostics._lock.acquire(blocking=False):
+            self.profile.enable()
+        else:
+            self.profile = None
+
+    def __exit__(self, *exc):
+        if self.profile is not None:
+            self.profile.disable()
+            self.diagnostics._lock.release()
+
+class Diagnostics:
+    '''
+    The process-wide log level and profiling, which can be switched at runtime from the
+    /Mgmt/LogLevel and /Mgmt/Profiling paths of any of our services, or with SIGUSR1 (toggle
+    profiling) and SIGUSR2 (toggle debug logging).
+
+    While profiling, the poll, decode and publish stages of every cycle run under cProfile and
+    tracemalloc is tracing. Every interval the stats are written to profile_dir - a .pstats file per
+    stage, for snakeviz or pstats, and a text summary of the top entries - along with the
+    biggest allocations and what's grown since the last dump.
+
+    When it's off, stage() costs one attribute check.
+    '''
+    def __init__(self, level='INFO', profile_dir=PROFILE_DIR, interval=PROFILE_INTERVAL, top=PROFILE_TOP):
+        self.level = level
+        self._quiet_level = level if level != 'DEBUG' else 'INFO' # what SIGUSR2 goes back to
+        self.profile_dir = profile_dir
+        self.interval = interval
+        self.top = top
+        self.profiling = False
+        self.products = [] # whose /Mgmt paths show our state
+        self._profiles = {} # stage: cProfile.Profile
+        self._lock = threading.Lock()
+        self._timer = None
+        self._snapshot = None # last tracemalloc snapshot, to compare with
+
+    def stage(self, name):
+        if not self.profiling:
+            return NULL_STAGE
+        return _Stage(self, name)
+
+    def set_level(self, level):
+        level = str(level).upper()
+        if level not in LOG_LEVELS:
+            return False
+        self.level = level
+        logging.getLogger().setLevel(level)
+        log.warning('Log level %s', level) # so there's a record of it in the log whatever the level
+        self._show()
+        return True
+
+    def toggle_debug(self):
+        if self.level == 'DEBUG':
+            self.set_level(self._quiet_level)
+        else:
+            self._quiet_level = self.level
+            self.set_level('DEBUG')
+
+    def set_profiling(self, on):
+        on = bool(on)
+        if on == self.profiling:
+            return
+        if on:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self._timer = GLib.timeout_add(self.interval*1000, self.dump)
+            log.warning('Profiling to %s every %ds', self.profile_dir, self.interval)
+        else:
+            GLib.source_remove(self._timer)
+            self._timer = None
+            self.dump()
+            tracemalloc.stop()
+            self._snapshot = None
+            log.warning('Profiling off')
+        self.profiling = on
+        self._show()
+
+    def _show(self):
+        for p in self.products:
+            p._publisher.forget('/Mgmt/LogLevel')
+            p._publisher.forget('/Mgmt/Profiling')
+            with p._publisher as s:
+                s['/Mgmt/LogLevel'] = self.level
+                s['/Mgmt/Profiling'] = int(self.profiling)
+
+    def dump(self):
+        '''Write out the profiles so far. Runs on the GLib timer while profiling.'''
+        if not self._lock.acquire(blocking=False):
+            return True # a worker's in the middle of a stage - next time
+        try:
+            for name, profile in self._profiles.items():
+                stats = pstats.Stats(profile)
+                stats.dump_stats(os.path.join(self.profile_dir, f'{name}.pstats'))
+                with open(os.path.join(self.profile_dir, f'{name}.txt'), 'w') as f:
+                    stats.stream = f
+                    stats.sort_stats('cumulative').print_stats(self.top)
+        finally:
+            self._lock.release()
+
+        if tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            ])
+            with open(os.path.join(self.profile_dir, 'tracemalloc.txt'), 'w') as f:
+                f.write(f'Top {self.top} allocations by line\n')
+                for stat in snapshot.statistics('lineno')[:self.top]:
+                    f.write(f'{stat}\n')
+                if self._snapshot is not None:
+                    f.write(f'\nTop {self.top} changes since the last dump\n')
+                    for stat in snapshot.compare_to(self._snapshot, 'lineno')[:self.top]:
+                        f.write(f'{stat}\n')
+            self._snapshot = snapshot
+        log.info('Wrote profiles to %s', self.profile_dir)
+        return True
+
+NULL_STAGE = contextlib.nullcontext()
+diagnostics = Diagnostics()
+
+# Rolling history of the measured values, in memory
+HISTORY_SAMPLES = 3600 # per path - an hour at one poll a second
+HISTORY_WINDOWS = ((60, '1m'), (300, '5m'), (900, '15m')) # (seconds, label)
+HISTORY_UNITS = ('W', 'V AC', 'A AC') # which paths get a history, by unit
+STATS_INTERVAL = 5 # seconds between publishing the /Stats paths
+HISTORY_INTERFACE = 'com.github.strocode.SungrowHistory'
+
+class RollingWindow:
+    '''
+    min, max and mean of one path's samples in the last seconds, kept up to date in O(1)
+    amortised per sample. min and max come from monotonic queues of sample numbers, kept in
+    ring arrays the size of the history, so nothing is allocated once it's running.
+    If we poll fast enough that the window holds more samples than the history, it's cut short.
+    '''
+    def __init__(self, history, values, seconds):
+        self.history = history
+        self.values = values
+        self.seconds = seconds
+        self.start = 0 # oldest sample number in the window
+        self.sum = 0.0
+        self.count = 0
+        n = history.capacity
+        self._mins = array.array('I', bytes(4*n)) # increasing values
+        self._maxs = array.array('I', bytes(4*n)) # decreasing values
+        self._min_head = self._min_tail = 0
+        self._max_head = self._max_tail = 0
+
+    def expire(self, t, seq):
+        # Before sample seq at time t overwrites the oldest slot
+        values, times, n = self.values, self.history.times, self.history.capacity
+        while self.start < seq and (times[self.start % n] <= t - self.seconds or self.start <= seq - n):
+            v = values[self.start % n]
+            if v == v: # not NaN
+                self.sum -= v
+                self.count -= 1
+            self.start += 1
+        while self._min_head < self._min_tail and self._mins[self._min_head % n] < self.start:
+            self._min_head += 1
+        while self._max_head < self._max_tail and self._maxs[self._max_head % n] < self.start:
+            self._max_head += 1
+
+    def push(self, seq, v):
+        if v != v:
+            return
+        self.sum += v
+        self.count += 1
+        values, n = self.values, self.history.capacity
+        # Anything at the back that's no smaller (bigger) than v can never be the min (max) again
+        while self._min_head < self._min_tail and values[self._mins[(self._min_tail - 1) % n] % n] >= v:
+            self._min_tail -= 1
+        self._mins[self._min_tail % n] = seq
+        self._min_tail += 1
+        while self._max_head < self._max_tail and values[self._maxs[(self._max_tail - 1) % n] % n] <= v:
+            self._max_tail -= 1
+        self._maxs[self._max_tail % n] = seq
+        self._max_tail += 1
+
+    @property
+    def min(self):
+        if self._min_head == self._min_tail:
+            return None
+        n = self.history.capacity
+        return self.values[self._mins[self._min_head % n] % n]
+
+    @property
+    def max(self):
+        if self._max_head == self._max_tail:
+            return None
+        n = self.history.capacity
+        return self.values[self._maxs[self._max_head % n] % n]
+
+    @property
+    def mean(self):
+        return self.sum/self.count if self.count else None
+
+class History:
+    '''
+    The last capacity samples of some paths that are updated together, in fixed arrays - one
+    of times, shared, and one of values per path, NaN where there wasn't one - with a
+    RollingWindow per path per window.
+    '''
+    def __init__(self, paths, capacity=HISTORY_SAMPLES, windows=HISTORY_WINDOWS):
+        self.capacity = capacity
+        self.windows = windows
+        self.times = array.array('d', bytes(8*capacity))
+        self.seq = 0 # samples so far
+        self.values = {p: array.array('d', [math.nan])*capacity for p in paths}
+        self.rolling = {p: [RollingWindow(self, self.values[p], seconds) for seconds, _ in windows] for p in paths}
+
+    def add(self, t, samples):
+        '''Add the samples {path: value} taken at monotonic time t'''
+        seq = self.seq
+        for ws in self.rolling.values():
+            for w in ws:
+                w.expire(t, seq)
+
+        i = seq % self.capacity
+        self.times[i] = t
+        for path, values in self.values.items():
+            v = samples.get(path)
+            v = math.nan if v is None else float(v)
+            values[i] = v
+            for w in self.rolling[path]:
+                w.push(seq, v)
+        self.seq += 1
+
+    def stats(self):
+        '''(path, label, RollingWindow) for every path and window'''
+        for path, ws in self.rolling.items():
+            for (_, label), w in zip(self.windows, ws):
+                yield path, label, w
+
+    def since(self, path, seconds):
+        '''([unix times], [values]) of path for the last seconds, oldest first'''
+        values = self.values[path]
+        now, wall = time.monotonic(), time.time()
+        times, out = [], []
+        for seq in range(self.seq - 1, max(0, self.seq - self.capacity) - 1, -1):
+            i = seq % self.capacity
+            if self.times[i] < now - seconds:
+                break
+            if values[i] == values[i]:
+                times.append(wall - (now - self.times[i]))
+                out.append(values[i])
+        return times[::-1], out[::-1]
+
+class HistoryExport(dbus.service.Object):
+    '''
+    GetHistory on /History of a product's service, for anyone who wants more than the last value
+    '''
+    def __init__(self, bus, history):
+        super().__init__(bus, '/History')
+        self.history = history
+
+    @dbus.service.method(HISTORY_INTERFACE, in_signature='asd', out_signature='a{s(adad)}')
+    def GetHistory(self, paths, seconds):
+        '''{path: (unix times, values)} for the last seconds of each of paths, or all of them if it's empty'''
+        paths = [str(p) for p in paths] or list(self.history.values)
+        return {p: self.history.since(p, float(seconds)) for p in paths if p in self.history.values}
+
+# Histogram bucket upper bounds, seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)
+PERF_INTERVAL = 10 # seconds between publishing perf stats
+
+class Histogram:
+    '''
+    Fixed bucket histogram, so recording a sample is a bisect and a couple of increments
+    '''
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0]*(len(buckets) + 1) # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, v):
+        self.counts[bisect.bisect_left(self.buckets, v)] += 1
+        self.count += 1
+        self.sum += v
+        if v > self.max:
+            self.max = v
+
+    def quantile(self, q):
+        '''Upper bound of the bucket holding the q quantile'''
+        if self.count == 0:
+            return 0
+        n = q*self.count
+        seen = 0
+        for bound, c in zip(self.buckets, self.counts):
+            seen += c
+            if seen >= n:
+                return min(bound, self.max)
+        return self.max
+
+class Perf:
+    '''
+    Performance counters for one device group. Times are in seconds.
+    The read side is updated from the modbus worker thread, the rest on the main loop.
+    '''
+    def __init__(self):
+        self.latency = {} # block start address: Histogram of modbus round trip
+        self.cycle = Histogram() # tick to values published
+        self.decode = Histogram()
+        self.publish = Histogram()
+        self.lateness = Histogram()
+        self.cycles = 0
+        self.transactions = 0 # in the last cycle
+        self.transactions_total = 0
+        self.timeouts = 0
+        self.errors = 0 # exception responses from the device
+        self.reconnects = 0
+        self.skipped = 0
+        self.circuit_skips = 0 # ticks not tried because the device is failing
+        self.writes = 0 # confirmed by reading back
+        self.write_errors = 0
+        self.write_latency = Histogram() # dbus SetValue to read back from the device
+
+    def block(self, start):
+        h = self.latency.get(start)
+        if h is None:
+            h = self.latency[start] = Histogram()
+        return h
+
+    def items(self):
+        '''
+        (path, value) pairs for the dbus, under /Mgmt/Perf. Times are in ms
+        '''
+        yield 'Cycles', self.cycles
+        yield 'Transactions', self.transactions
+        yield 'Timeouts', self.timeouts
+        yield 'Errors', self.errors
+        yield 'Reconnects', self.reconnects
+        yield 'Skipped', self.skipped
+        yield 'CircuitSkips', self.circuit_skips
+        yield 'Writes', self.writes
+        yield 'WriteErrors', self.write_errors
+        hists = [('CycleTime', self.cycle), ('Decode', self.decode), ('Publish', self.publish), ('Lateness', self.lateness),
+                 ('WriteLatency', self.write_latency)]
+        hists += [(f'Latency/{start}', h) for start, h in sorted(self.latency.items())]
+        for name, h in hists:
+            yield name + '/P50', round(h.quantile(0.5)*1000, 1)
+            yield name + '/P95', round(h.quantile(0.95)*1000, 1)
+            yield name + '/Max', round(h.max*1000, 1)
+
+    def prometheus(self, device):
+        '''
+        Lines in the prometheus text format, for node_exporter's textfile collector
+        '''
+        label = f'device="{device}"'
+        for name, v in [('cycles', self.cycles), ('transactions', self.transactions_total), ('timeouts', self.timeouts),
+                        ('errors', self.errors), ('reconnects', self.reconnects), ('skipped_cycles', self.skipped),
+                        ('circuit_skips', self.circuit_skips),
+                        ('writes', self.writes), ('write_errors', self.write_errors)]:
+            yield f'sungrow_{name}_total{{{label}}} {v}'
+
+        hists = [('cycle', label, self.cycle), ('decode', label, self.decode), ('publish', label, self.publish),
+                 ('lateness', label, self.lateness), ('write', label, self.write_latency)]
+        hists += [('modbus_latency', f'{label},block="{start}"', h) for start, h in sorted(self.latency.items())]
+        for name, labels, h in hists:
+            total = 0
+            for bound, c in zip(h.buckets, h.counts):
+                total += c
+                yield f'sungrow_{name}_seconds_bucket{{{labels},le="{bound}"}} {total}'
+            yield f'sungrow_{name}_seconds_bucket{{{labels},le="+Inf"}} {h.count}'
+            yield f'sungrow_{name}_seconds_sum{{{labels}}} {h.sum}'
+            yield f'sungrow_{name}_seconds_count{{{labels}}} {h.count}'
+
+def write_textfile(path, groups):
+    '''
+    Write all the groups' perf counters to a node_exporter textfile. Written to a temporary file
+    and renamed so the collector never sees half a file.
+    '''
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        for g in groups:
+            for line in g.perf.prometheus(g.name):
+                f.write(line + '\n')
+    os.replace(tmp, path)
+    return True # keep the GLib timer going
+
+# Where we keep state that should survive restarts and firmware updates (/data is kept on Venus)
+STATE_DIR = os.path.dirname(os.path.abspath(__file__))
+ENERGY_FLUSH_INTERVAL = 300 # seconds between energy checkpoints
+ENERGY_FLUSH_DELTA = 0.1 # kWh - checkpoint sooner if any counter has moved this much
+
+class EnergyStore:
+    '''
+    Keeps the per phase energy accumulators in a small memory mapped file so they survive
+    restarts. There are two fixed size slots, written alternately, each with a sequence number
+    and a crc, so a write cut short by a crash or power cut leaves the previous checkpoint intact.
+
+    To go easy on the flash, it's only synced every interval seconds, or sooner if any counter
+    has moved by more than delta kWh.
+
+    The device's own lifetime counter is stored with each checkpoint, along with the total of
+    our phase energies when the counter last moved - it's only read every so often, and counts
+    whole kWh, so it's behind what we've integrated. On startup the energy the device made while
+    we weren't running (or since the last checkpoint) is added back on, less what we'd already
+    integrated since the counter moved, shared between the phases, so nothing is lost or
+    counted twice.
+    '''
+    MAGIC = b'SGE2'
+    # magic, sequence, lifetime counter, our total when it moved, phase energies
+    SLOT = struct.Struct('<4sQdd3d')
+    CRC = struct.Struct('<I')
+    SIZE = SLOT.size + CRC.size
+    LEGACY_MAGIC = b'SGE1' # before the total was stored, read so an upgrade keeps the counters
+    LEGACY_SLOT = struct.Struct('<4sQd3d')
+
+    def __init__(self, path, interval=ENERGY_FLUSH_INTERVAL, delta=ENERGY_FLUSH_DELTA):
+        self.path = path
+        self.interval = interval
+        self.delta = delta
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            legacy = None
+            if os.fstat(fd).st_size == 2*(self.LEGACY_SLOT.size + self.CRC.size):
+                legacy = os.pread(fd, 2*(self.LEGACY_SLOT.size + self.CRC.size), 0)
+            if os.fstat(fd).st_size != 2*self.SIZE:
+                os.ftruncate(fd, 2*self.SIZE)
+            self._mm = mmap.mmap(fd, 2*self.SIZE)
+        finally:
+            os.close(fd)
+
+        self.seq = 0
+        self.energies = None
+        self.lifetime = None
+        self.lifetime_energy = None # total of the energies when the lifetime counter moved to lifetime
+        self._load(legacy)
+        self.latest_lifetime = self.lifetime
+        self._synced = False
+        self._flushed = (self.energies or [0, 0, 0], time.monotonic())
+
+    def _load(self, legacy=None):
+        best = None
+        buf, slot, magic = self._mm, self.SLOT, self.MAGIC
+        if legacy is not None:
+            buf, slot, magic = legacy, self.LEGACY_SLOT, self.LEGACY_MAGIC
+        size = slot.size + self.CRC.size
+        for i in range(2):
+            data = buf[i*size:i*size + slot.size]
+            if zlib.crc32(data) != self.CRC.unpack_from(buf, i*size + slot.size)[0]:
+                continue
+            m, seq, lifetime, *energies = slot.unpack(data)
+            if legacy is None:
+                lifetime_energy, *energies = energies
+            else:
+                lifetime_energy = sum(energies) # don't know, so as if it had just moved
+            if m == magic and (best is None or seq > best[0]):
+                best = (seq, lifetime, lifetime_energy, energies)
+
+        if best is None:
+            log.info('No valid energy checkpoint in %s', self.path)
+            return
+
+        self.seq, lifetime, self.lifetime_energy, self.energies = best
+        self.lifetime = None if lifetime < 0 else lifetime
+        log.info('Restored energies %s (lifetime %s) from %s', self.energies, self.lifetime, self.path)
+
+    def sync(self, energies, lifetime):
+        '''
+        The first time we see the device's lifetime counter, add on whatever it has made since the
+        checkpoint. energies is updated in place.
+        '''
+        if self._synced or lifetime is None:
+            return
+        self._synced = True
+        if self.lifetime is None:
+            return
+
+        # What the counter has moved by, less what we integrated after it last moved before we stopped
+        missed = lifetime - self.lifetime - (sum(energies) - self.lifetime_energy)
+        self.latest_lifetime = lifetime
+        self.lifetime_energy = sum(energies)
+        if missed <= 0:
+            # Nothing made, or the counter went backwards (reset, or a different device) - leave it
+            return
+
+        total = sum(energies)
+        for phase in range(len(energies)):
+            share = energies[phase]/total if total > 0 else 1/len(energies)
+            energies[phase] += missed*share
+        self.lifetime_energy = sum(energies)
+        log.info('Added %.1f kWh made while we were down', missed)
+
+    def update(self, energies, lifetime, now):
+        if lifetime is not None and lifetime != self.latest_lifetime:
+            self.latest_lifetime = lifetime
+            self.lifetime_energy = sum(energies)
+        last, t = self._flushed
+        if now - t >= self.interval or max(abs(a - b) for a, b in zip(energies, last)) >= self.delta:
+            self.flush(energies, now)
+
+    def flush(self, energies, now=None):
+        lifetime = self.latest_lifetime
+        lifetime_energy = sum(energies) if self.lifetime_energy is None else self.lifetime_energy
+        self.seq += 1
+        data = self.SLOT.pack(self.MAGIC, self.seq, -1 if lifetime is None else lifetime, lifetime_energy,
+                              *energies)
+        slot = self.seq % 2
+        self._mm[slot*self.SIZE:(slot + 1)*self.SIZE] = data + self.CRC.pack(zlib.crc32(data))
+        self._mm.flush()
+        self.lifetime = lifetime
+        self._flushed = (list(energies), time.monotonic() if now is None else now)
+
+# Adaptive polling
+ADAPT_MIN_INTERVAL = 0.25 # seconds - fastest we'll poll when the power is moving quickly
+ADAPT_IDLE_INTERVAL = 30 # seconds - when the inverter is in standby
+ADAPT_FLAT_INTERVAL = 30 # seconds - slowest we'll back off to when the power is flat
+ADAPT_FAST_RATE = 200 # W/s - faster than this and we poll as fast as we can
+ADAPT_FLAT_DELTA = 20 # W - less change than this between polls counts as flat
+ADAPT_BACKOFF = 1.5 # how much the interval grows each poll when backing off
+
+class AdaptiveRate:
+    '''
+    Works out how often a product wants polling from how its power is moving - as fast as
+    floor while it's changing faster than fast_rate, backing off to flat while it's not moving
+    and idle while the device is in standby. Otherwise it eases back to base.
+    '''
+    def __init__(self, base, floor=ADAPT_MIN_INTERVAL, idle=ADAPT_IDLE_INTERVAL, flat=ADAPT_FLAT_INTERVAL,
+                 fast_rate=ADAPT_FAST_RATE, flat_delta=ADAPT_FLAT_DELTA):
+        self.base = base
+        self.floor = min(floor, base)
+        self.idle = idle
+        self.flat = flat
+        self.fast_rate = fast_rate
+        self.flat_delta = flat_delta
+        self.interval = base
+        self._last = None # (time, power)
+
+    def update(self, t, power, standby=False):
+        '''Returns the interval (s) wanted after a sample of power (W) at time t'''
+        last, self._last = self._last, (t, power)
+        if standby:
+            self.interval = self.idle
+        elif power is None or last is None or t <= last[0]:
+            self.interval = self.base
+        else:
+            delta = abs(power - last[1])
+            if delta/(t - last[0]) >= self.fast_rate:
+                self.interval = self.floor
+            elif delta < self.flat_delta:
+                self.interval = min(max(self.flat, self.base), self.interval*ADAPT_BACKOFF)
+            else:
+                self.interval = self.base if self.interval > self.base else min(self.base, self.interval*ADAPT_BACKOFF)
+        return self.interval
+# Derived quantities
+PHASES = 3
+KWH = 3600*1000 # W.s
+
+def _ratio(a, b):
+    return a/b if b else math.nan
+
+def _max(a, b):
+    # max() that stays NaN if either is, as arithmetic does
+    return (a + b + abs(a - b))/2
+
+def _valid(v, n, unit):
+    return None if v != v else roundu(v, n, unit)
+
+class DerivedStage:
+    '''
+    Quantities worked out from the phase samples of all the products at once, rather than in a
+    loop per product per phase: phase power where the device only gives volts and amps, the power
+    factor, how unbalanced the phases are, the energy each phase has put through since the last
+    sample, and the net flow for the site - what the inverters make less what the meters measure.
+
+    Products put their samples in a row of flat arrays with sample(), and their group calls
+    run() once they've all published, inside their publishers, so the rows with new samples are
+    worked out together and go out in the same ItemsChanged as the values they came from -
+    devices that are polled together are done in one pass over their part of the arrays. A group's products have rows
+    next to each other, and only the runs of rows with new samples are touched, so the work per
+    sample doesn't grow with the number of devices. The site flow is a running total for the
+    same reason. Missing values are NaN, which carries through the arithmetic so nothing needs
+    checking per value.
+    '''
+    def __init__(self):
+        self.products = []
+        self.sign = array.array('d') # per row - 1 for inverters, -1 for meters, for the site flow
+        self.total = array.array('d') # per row - the device's total power
+        self.t = array.array('d') # per row - time of the sample
+        self.computed = [] # per row - whether the phase power is volts times amps
+        self.volts = array.array('d') # per phase of each row from here on
+        self.amps = array.array('d')
+        self.watts = array.array('d')
+        self.watts0 = array.array('d') # at the sample before
+        self.dt = array.array('d') # since the sample before, NaN if it's too long to integrate over
+        self._site = 0.0 # sign times total of the rows that have one
+        self._missing = 0 # rows that don't
+        self._dirty = set()
+
+    def add(self, product, sign):
+        '''Add a row for product, returning its number'''
+        self.products.append(product)
+        self.sign.append(sign)
+        self.total.append(math.nan)
+        self._missing += 1
+        self.t.append(math.nan)
+        self.computed.append(False)
+        for a in (self.volts, self.amps, self.watts, self.watts0, self.dt):
+            a.extend([math.nan]*PHASES)
+        return len(self.products) - 1
+
+    def sample(self, row, t, total, watts=None, volts=None, amps=None):
+        '''
+        A product's sample read at t - its phase powers, or their volts and amps to work them out from
+        '''
+        if row in self._dirty:
+            self.run() # a second sample before we got to the first, e.g. replaying flat out
+        t = time.monotonic() if t is None else t
+        dt = t - self.t[row]
+        i = row*PHASES
+        nans = [math.nan]*PHASES
+        self.dt[i:i + PHASES] = array.array('d', [dt]*PHASES if 0 < dt <= MAX_INTEGRATION_DT else nans)
+        self.t[row] = t
+        self._set_total(row, math.nan if total is None else total)
+        self.computed[row] = watts is None
+        for a, v in ((self.watts, watts), (self.volts, volts), (self.amps, amps)):
+            a[i:i + PHASES] = array.array('d', nans if v is None else [math.nan if x is None else x for x in v])
+
+        self._dirty.add(row)
+
+    def clear(self, row):
+        '''The product has gone away - leave it out of the site flow until it's back'''
+        self._set_total(row, math.nan)
+
+    def _set_total(self, row, total):
+        old = self.total[row]
+        if old == old:
+            self._site -= self.sign[row]*old
+        else:
+            self._missing -= 1
+        if total == total:
+            self._site += self.sign[row]*total
+        else:
+            self._missing += 1
+        if self._missing == len(self.products):
+            self._site = 0.0 # start again, so rounding doesn't build up
+        self.total[row] = total
+
+    @property
+    def site(self):
+        '''Net power of the site, NaN until every device has answered'''
+        return math.nan if self._missing else self._site
+
+    def run(self):
+        '''Work out and publish the rows with new samples'''
+        rows = sorted(self._dirty)
+        self._dirty.clear()
+        start = 0
+        for k in range(1, len(rows) + 1):
+            if k == len(rows) or rows[k] != rows[k - 1] + 1:
+                self._run(rows[start], rows[k - 1] + 1)
+                start = k
+
+    def _run(self, first, end):
+        # Rows first to end - 1, which all have new samples
+        n = PHASES
+        i, j = first*n, end*n
+        va = array.array('d', map(operator.mul, self.volts[i:j], self.amps[i:j]))
+        for row in range(first, end):
+            if self.computed[row]:
+                k = (row - first)*n
+                self.watts[row*n:(row + 1)*n] = va[k:k + n]
+        watts = self.watts[i:j]
+
+        # Trapezoidal rule, using the measured time between samples rather than the poll interval
+        energy = array.array('d', map(operator.mul, map(operator.add, self.watts0[i:j], watts), self.dt[i:j]))
+        self.watts0[i:j] = watts
+
+        phases = [watts[k::n] for k in range(n)]
+        mean = [sum(p)/n for p in zip(*phases)]
+        deviation = [map(abs, map(operator.sub, p, mean)) for p in phases]
+        worst = deviation[0]
+        for d in deviation[1:]:
+            worst = map(_max, worst, d)
+        imbalance = list(map(_ratio, worst, map(abs, mean)))
+        apparent = [sum(p) for p in zip(*[va[k::n] for k in range(n)])]
+        power_factor = list(map(_ratio, self.total[first:end], apparent))
+        site = self.site
+
+        for r, row in enumerate(range(first, end)):
+            i = r*n
+            p = self.products[row]
+            try:
+                with p._publisher as s:
+                    energies = p.phase_energies
+                    for k in range(n):
+                        if energy[i + k] == energy[i + k]:
+                            energies[k] += energy[i + k]/2/KWH
+                    p._update_derived(s, watts[i:i + n], power_factor[r], imbalance[r], site)
+                    if p.history is not None:
+                        p._publish_history(s, self.t[row])
+            except:
+                log.exception('Exception doing derived update')
+
+derived = DerivedStage()
+
+def load_identity(path):
+    '''
+    What the device told us about itself last time - {path: value} of the static paths - so
+    they can be right from the moment we're on the dbus rather than when the dongle first answers
+    '''
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError):
+        log.warning('Ignoring bad identity file %s', path, exc_info=True)
+        return {}
+
+def save_identity(path, identity):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(identity, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
 
 class SungrowProduct:
-    def __init__(self, client, productname, servicename, deviceinstance):
-        self._dbusservice = VeDbusService(servicename, bus=SystemBus())
+    # Path of the device's own lifetime energy counter, to check our accumulators against
+    lifetime_path = None
+    # Path the adaptive poll rate watches
+    power_path = '/Ac/Power'
+    # Whether we add to the site's power (1) or measure what it takes (-1) - see DerivedStage
+    site_sign = 0
+
+    def __init__(self, client, productname, servicename, deviceinstance, bus=None, state_dir=None):
+        # Each product needs its own bus connection - see SystemBus
+        self.servicename = servicename
+        self._bus = bus or SystemBus()
+        self._dbusservice = VeDbusService(servicename, bus=self._bus)
+        self._publisher = Publisher(self._dbusservice)
+        self._perf_paths = set()
         self._client = client
         self._paths = []
-        self._interval_ms = 1000
+        self._regs = []
+        self._writeable = {} # path: Reg
+        self._units = {} # path: unit
+        self.history = None # History, if we're keeping one
+        self._history_export = None
+        self._stats_time = None # when the /Stats paths were last published
+        self.group = None # the DeviceGroup polling us
+        self.adaptive = None # AdaptiveRate, if we're polling adaptively
+        self.phase_energies = [0,0,0] # integrated by the DerivedStage
+        self._row = derived.add(self, self.site_sign)
+        self._energy_store = None
+        self._identity_path = None
+        self._identity = {} # static path: value, from the cache until the device answers
+        if state_dir:
+            self._energy_store = EnergyStore(os.path.join(state_dir, servicename + '.energy'))
+            if self._energy_store.energies:
+                self.phase_energies = list(self._energy_store.energies)
+            self._identity_path = os.path.join(state_dir, servicename + '.identity')
+            self._identity = load_identity(self._identity_path)
 
-        logging.debug("%s /DeviceInstance = %d" % (servicename, deviceinstance))
+        log.debug('%s /DeviceInstance = %d', servicename, deviceinstance)
         connection=str(self._client)
 
         # Create the management objects, as specified in the ccgx dbus-api document
         self._dbusservice.add_path('/Mgmt/ProcessName', __file__)
         self._dbusservice.add_path('/Mgmt/ProcessVersion', 'Unkown version, and running on Python ' + platform.python_version())
         self._dbusservice.add_path('/Mgmt/Connection', connection)
+        self._dbusservice.add_path('/Mgmt/Publish/Published', 0)
+        self._dbusservice.add_path('/Mgmt/Publish/Suppressed', 0)
+        self._dbusservice.add_path('/Mgmt/PollInterval', 0) # ms, as it is right now
+        self._dbusservice.add_path('/Mgmt/LogLevel', diagnostics.level, writeable=True,
+                                   onchangecallback=lambda path, value: diagnostics.set_level(value))
+        self._dbusservice.add_path('/Mgmt/Profiling', int(diagnostics.profiling), writeable=True,
+                                   onchangecallback=self._set_profiling)
+        diagnostics.products.append(self)
+        self._publisher.set_deadband('/Mgmt/Publish/Published', relative=0.1)
+        self._publisher.set_deadband('/Mgmt/Publish/Suppressed', relative=0.1)
 
         # Create the mandatory objects
         self._dbusservice.add_path('/DeviceInstance', deviceinstance)
         self._dbusservice.add_path('/ProductName', productname)
         self._dbusservice.add_path('/FirmwareVersion', 0)
         self._dbusservice.add_path('/HardwareVersion', 0)
-        productid = 0
-        connected = 0
-        try:
-            productid=self.read(5000)
-            connected = 1
-        except:
-            log.info('not connected')
-            productid = 0
-            connected = 0
-            
-        self._dbusservice.add_path('/ProductId', productid)
-        self._dbusservice.add_path('/Connected', connected)
-        GLib.timeout_add(self._interval_ms, self._update_robust)
+        self += Reg('/ProductId', 5000, tier='static') # Device type code
+        self._dbusservice.add_path('/Connected', 0)
 
 
     def __iadd__(self, d):
-        path = d[0]
-        initial_value= 0
-        self._dbusservice.add_path(path, initial_value)
+        '''
+        Add a dbus path. Either a Reg, or a tuple of (path, unit[, address[, scale]])
+        '''
+        if not isinstance(d, Reg) and len(d) > 2:
+            d = Reg(d[0], d[2], d[1], *d[3:])
+
+        if isinstance(d, Reg):
+            self._regs.append(d)
+            path, unit = d.path, d.unit
+        else:
+            path, unit = d[0], d[1]
+
+        if unit in DEADBANDS:
+            self._publisher.set_deadband(path, *DEADBANDS[unit])
+        self._units[path] = unit
+
+        initial_value = self._identity.get(path, 0)
+        if isinstance(d, Reg) and d.writeable:
+            self._writeable[path] = d
+            self._dbusservice.add_path(path, initial_value, writeable=True, onchangecallback=self._handlechangedvalue)
+        else:
+            self._dbusservice.add_path(path, initial_value)
         return self
 
+    def _handlechangedvalue(self, path, value):
+        log.debug('someone else updated %s to %s', path, value)
+        reg = self._writeable.get(path)
+        if reg is None or self.group is None:
+            return False
+        try:
+            value = self._limit(reg, float(value))
+            reg.encode(value) # check it fits
+        except (TypeError, ValueError, OverflowError) as e:
+            log.warning('%s: not writing %s = %r: %s', self.servicename, path, value, e)
+            return False
+
+        self._publisher.forget(path)
+        self.group.write(reg, value)
+        return True # accept the change - it's confirmed when we read it back
+
+    def _limit(self, reg, value):
+        '''The value to write to reg when someone asks for value. Raises ValueError if it can't be done'''
+        return value
+
+    def _set_profiling(self, path, value):
+        try:
+            diagnostics.set_profiling(int(value))
+        except (TypeError, ValueError):
+            return False
+        return True
+
     def read(self, addr, n=1):
         return read(self._client, addr, n)
 
-    def _update_robust(self):
-        log.debug('Update robust')
-        with self._dbusservice as s:
+    def publish_perf(self, perf):
+        with self._publisher as s:
+            for name, value in perf.items():
+                path = '/Mgmt/Perf/' + name
+                if path not in self._perf_paths:
+                    # Blocks aren't known until they've been planned, so add paths as we go
+                    self._dbusservice.add_path(path, value)
+                    self._perf_paths.add(path)
+                s[path] = value
+
+    def _update_derived(self, s, watts, power_factor, imbalance, site):
+        '''Publish what the DerivedStage worked out from our last sample'''
+        for phase in range(PHASES):
+            p = phase + 1
+            s[f'/Ac/L{p}/Power'] = _valid(watts[phase], 1, 'W')
+            s[f'/Ac/L{p}/Energy/Forward'] = roundu(self.phase_energies[phase], 1, 'kWh')
+        for path, v, n in (('/Ac/PowerFactor', power_factor, 2), ('/Ac/Imbalance', 100*imbalance, 1),
+                           ('/Site/NetPower', site, 1)):
+            if path in self._units:
+                s[path] = _valid(v, n, self._units[path])
+
+    def _publish_writes(self, values):
+        '''Publish read backs from a write-only cycle'''
+        with self._publisher as s:
+            for r in self._writeable.values():
+                if r in values:
+                    s[r.path] = values[r]
+
+    def enable_history(self, capacity=HISTORY_SAMPLES):
+        '''
+        Keep the last capacity samples of the measured paths, with their rolling min, max and mean
+        published on /Stats/<path>/<window>/ and the samples themselves available from GetHistory
+        '''
+        paths = [p for p, unit in self._units.items() if unit in HISTORY_UNITS and p not in self._writeable]
+        self.history = History(paths, capacity)
+        self._publisher.samples = {}
+        for path, label, _ in self.history.stats():
+            for stat in ('Min', 'Max', 'Mean'):
+                stat_path = f'/Stats{path}/{label}/{stat}'
+                self._dbusservice.add_path(stat_path, None)
+                self._publisher.set_deadband(stat_path, *DEADBANDS[self._units[path]])
+        self._history_export = HistoryExport(self._bus, self.history)
+
+    def _publish_history(self, s, t):
+        samples = self._publisher.samples
+        self.history.add(t, samples)
+        samples.clear()
+        if self._stats_time is not None and t - self._stats_time < STATS_INTERVAL:
+            return
+        self._stats_time = t
+        for path, label, w in self.history.stats():
+            s[f'/Stats{path}/{label}/Min'] = roundu(w.min, 1, '')
+            s[f'/Stats{path}/{label}/Max'] = roundu(w.max, 1, '')
+            s[f'/Stats{path}/{label}/Mean'] = roundu(w.mean, 1, '')
+
+    def standby(self, values):
+        '''Whether the device says it's asleep, from the {reg: value} of a poll'''
+        return False
+
+    def poll_interval(self, values, t):
+        '''
+        The interval (s) we'd like to be polled at after the {reg: value} read at t, or None
+        if we're not fussy
+        '''
+        if self.adaptive is None:
+            return None
+        reg = next((r for r in self._regs if r.path == self.power_path), None)
+        return self.adaptive.update(t, values.get(reg), self.standby(values))
+
+    def _check_identity(self, values):
+        # Save the identity for next time if it's changed, e.g. a firmware update or a new inverter
+        identity = {r.path: values[r.path] for r in self._regs if r.tier == 'static'}
+        if identity == self._identity:
+            return
+        log.info('%s identity %s', self.servicename, identity)
+        self._identity = identity
+        if self._identity_path is not None:
+            try:
+                save_identity(self._identity_path, identity)
+            except OSError:
+                log.warning('Can\'t save %s', self._identity_path, exc_info=True)
+
+    def checkpoint(self):
+        '''Save the energy accumulators now, e.g. on the way out'''
+        if self._energy_store is not None:
+            self._energy_store.flush(self.phase_energies)
+
+    def _update_robust(self, values, t=None):
+        '''
+        Publish the values from one poll cycle. values is {reg: value}, or None if the read failed.
+        t is the monotonic time the values were read
+        '''
+        with self._publisher as s:
+            s['/Mgmt/Publish/Published'] = self._publisher.published
+            s['/Mgmt/Publish/Suppressed'] = self._publisher.suppressed
+            if self.group is not None:
+                s['/Mgmt/PollInterval'] = round(self.group.period*1000)
+            if values is None:
+                s['/Connected'] = 0
+                derived.clear(self._row)
+                return
+
             try:
-                self._update(s)
+                values = {r.path: values.get(r) for r in self._regs} # None if the model doesn't have it
+                for r in self._regs:
+                    if r.tier == 'static' or r.writeable:
+                        s[r.path] = values[r.path]
+                self._check_identity(values)
+
+                store = self._energy_store
+                lifetime = values.get(self.lifetime_path)
+                if store is not None:
+                    store.sync(self.phase_energies, lifetime)
+
+                self._update(s, values, t) # and the group has the DerivedStage publish the rest, and the history
                 s['/Connected'] = 1
+
+                if store is not None:
+                    store.update(self.phase_energies, lifetime, t)
             except:
                 log.exception('Exception doing update')
                 s['/Connected'] = 0
 
-        GLib.timeout_add(self._interval_ms, self._update_robust)
+WRITE_INTERVAL = 0.5 # seconds - don't write the same register more often than this
+
+# Connection health
+PROBE_ADDRESS = 5000 # cheap register that every model has
+PROBE_TIMEOUT = 0.5 # seconds - a live dongle answers much quicker than this
+IDLE_PROBE = 10 # seconds - probe before using a connection that's been quiet this long
+BREAKER_FAILURES = 2 # consecutive failed cycles before we stop trying every tick
+BACKOFF_BASE = 2 # seconds
+BACKOFF_MAX = 120
+
+class Connection:
+    '''
+    Looks after the modbus client for one dongle, shared by all the groups behind it.
+
+    After a failure the socket is closed so the next attempt starts afresh, and the next cycle
+    starts with a probe read with a short timeout - as does one after the connection has been
+    idle - so a dead or half-open socket is found in PROBE_TIMEOUT rather than the full timeout.
+    After BREAKER_FAILURES failed cycles in a row the circuit opens and we don't try again until
+    an exponential backoff (with jitter) has passed, so a dead device doesn't eat worker time.
+
+    The groups behind one dongle can't use it at the same time, so their jobs are queued here
+    with submit() and run one after another by a single job on the executor, rather than each
+    taking a worker thread just to wait for the lock - which would hold up other dongles'
+    groups when the pool has one thread per dongle.
+
+    allow() and record() are called on the main loop, probe() and drop() on the worker with lock held.
+    '''
+    def __init__(self, client):
+        self.client = client
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.retry_at = 0
+        self.last_ok = 0
+        self._jobs = collections.deque() # (Future, fn) waiting for the connection
+        self._jobs_lock = threading.Lock()
+        self._draining = False # a job on the executor is working through _jobs
+
+    def submit(self, executor, fn, *args):
+        '''Like executor.submit(), but after everything already submitted for this connection'''
+        future = Future()
+        with self._jobs_lock:
+            self._jobs.append((future, lambda: fn(*args)))
+            if self._draining:
+                return future
+            self._draining = True
+        executor.submit(self._drain)
+        return future
+
+    def _drain(self):
+        # On the worker
+        while True:
+            with self._jobs_lock:
+                if not self._jobs:
+                    self._draining = False
+                    return
+                future, fn = self._jobs.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn())
+            except BaseException as e:
+                future.set_exception(e)
+
+    @property
+    def state(self):
+        if self.failures < BREAKER_FAILURES:
+            return 'closed'
+        return 'half-open' if time.monotonic() >= self.retry_at else 'open'
+
+    def allow(self, now):
+        return self.failures < BREAKER_FAILURES or now >= self.retry_at
+
+    def record(self, alive, now):
+        if alive:
+            if self.failures:
+                log.info('%s back after %d failures', self.client, self.failures)
+            self.failures = 0
+            self.last_ok = now
+            return
+
+        self.failures += 1
+        if self.failures >= BREAKER_FAILURES:
+            delay = min(BACKOFF_MAX, BACKOFF_BASE*2**(self.failures - BREAKER_FAILURES))
+            self.retry_at = now + random.uniform(delay/2, delay)
+            log.info('%s failed %d times, next try in %.0fs', self.client, self.failures, self.retry_at - now)
+
+    def stale(self, now):
+        return self.failures > 0 or now - self.last_ok > IDLE_PROBE
+
+    def probe(self, unit):
+        client = self.client
+        timeout = client.timeout
+        client.timeout = PROBE_TIMEOUT # also used by connect()
+        try:
+            if client.socket is not None:
+                client.socket.settimeout(PROBE_TIMEOUT)
+            rr = client.read_input_registers(PROBE_ADDRESS-1, 1, unit=unit)
+        finally:
+            client.timeout = timeout
+            if client.socket is not None:
+                client.socket.settimeout(timeout)
+
+        if rr.isError() and not isinstance(rr, ExceptionResponse):
+            raise IOError(f'No response to probe of {client}: {rr}')
+
+    def drop(self):
+        self.client.close()
+
+
+# Raw register recordings
+RECORD_WORDS = MAX_BLOCK # bigger blocks are split over several slots
+RECORDING_SIZE = 32 # MB - about a day at one poll a second
+REPLAY_BATCH = 100 # cycles per main loop iteration when replaying flat out
+
+class Recorder:
+    '''
+    Keeps every register block a group reads, with the monotonic time it was read, in a ring
+    file of fixed size slots so it never grows past size bytes. When it's full the oldest
+    slots are overwritten. Each slot has a sequence number so they can be put back in order,
+    the poll cycle it came from and a crc so a slot torn by a crash is skipped.
+
+    Static registers are only read once, so every quarter of the ring a cycle also records the
+    last words of every other block we've seen. That way there's always a full set to start
+    a replay from.
+
+    Only used by the group's poll(), on the worker thread with the connection lock held.
+    '''
+    MAGIC = b'SGRR'
+    HEADER = struct.Struct('<4sHH') # magic, version, words per slot
+    SLOT = struct.Struct(f'<IIdBxHH{RECORD_WORDS}H') # seq, cycle, time, kind, start, count, words
+    CRC = struct.Struct('<I')
+    KINDS = ('input', 'holding')
+
+    def __init__(self, path, size=RECORDING_SIZE*1024*1024):
+        self.path = path
+        self.slots = max(1, (size - self.HEADER.size)//(self.SLOT.size + self.CRC.size))
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.seq = 0
+        self.cycle = 0
+        self._blocks = {} # (kind, start): (block, words) last read
+        self._keyframe = None # seq of the last full cycle
+        last = None
+        for seq, cycle, *_ in Recording(path).slots():
+            if last is None or seq > last[0]:
+                last = (seq, cycle)
+        if last is not None:
+            self.seq, self.cycle = last[0] + 1, last[1] + 1
+        else:
+            os.pwrite(self._fd, self.HEADER.pack(self.MAGIC, 1, RECORD_WORDS), 0)
+
+    def record(self, t, blocks):
+        '''blocks is [(Block, words)] read in one cycle, t the time it finished'''
+        for block, words in blocks:
+            self._blocks[(block.kind, block.start)] = (block, words)
+        if self._keyframe is None or self.seq - self._keyframe >= self.slots//4:
+            self._keyframe = self.seq
+            blocks = self._blocks.values()
+
+        for block, words in blocks:
+            kind = self.KINDS.index(block.kind)
+            for i in range(0, len(words), RECORD_WORDS):
+                chunk = words[i:i + RECORD_WORDS]
+                slot = self.SLOT.pack(self.seq & 0xffffffff, self.cycle & 0xffffffff, t, kind, block.start + i,
+                                      len(chunk), *chunk, *[0]*(RECORD_WORDS - len(chunk)))
+                offset = self.HEADER.size + (self.seq % self.slots)*(self.SLOT.size + self.CRC.size)
+                os.pwrite(self._fd, slot + self.CRC.pack(zlib.crc32(slot)), offset)
+                self.seq += 1
+        self.cycle += 1
+
+    def close(self):
+        os.close(self._fd)
+
+class Recording:
+    '''
+    Reads back a Recorder file
+    '''
+    def __init__(self, path):
+        self.path = path
+
+    def slots(self):
+        '''
+        (seq, cycle, time, kind, start, words) for every good slot, oldest first. Slot i holds
+        seq i modulo the size of the ring, so they're in order from the oldest one round to the
+        newest - that's found first, then they're read from there without holding them all.
+        '''
+        slot, crc, header = Recorder.SLOT, Recorder.CRC, Recorder.HEADER
+        size = slot.size + crc.size
+        with open(self.path, 'rb') as f:
+            data = f.read(header.size)
+            if len(data) < header.size:
+                return
+            magic, version, words = header.unpack(data)
+            if magic != Recorder.MAGIC or words != RECORD_WORDS:
+                raise ValueError(f'{self.path} isn\'t a recording we can read')
+            n = (os.fstat(f.fileno()).st_size - header.size)//size
+            if n == 0:
+                return
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        def body(i):
+            # The slot's contents, or None if it's never been written or is torn
+            at = header.size + i*size
+            data = mm[at:at + slot.size]
+            return data if crc.unpack_from(mm, at + slot.size)[0] == zlib.crc32(data) else None
+
+        with mm:
+            oldest = None # (seq, slot number)
+            for i in range(n):
+                data = body(i)
+                if data is not None:
+                    seq = struct.unpack_from('<I', data)[0]
+                    if oldest is None or seq < oldest[0]:
+                        oldest = (seq, i)
+            if oldest is None:
+                return
+            for i in range(oldest[1], oldest[1] + n):
+                data = body(i % n)
+                if data is not None:
+                    seq, cycle, t, kind, start, count, *words = slot.unpack(data)
+                    yield seq, cycle, t, Recorder.KINDS[kind], start, words[:count]
+
+    def cycles(self):
+        '''
+        (time, {(kind, address): word}) for each recorded poll cycle, oldest first. Cycles that
+        have been partly overwritten are dropped.
+        '''
+        cycle = None
+        for i, (seq, c, t, kind, start, words) in enumerate(self.slots()):
+            if c != cycle:
+                if cycle is not None and regs is not None:
+                    yield t0, regs
+                cycle, t0 = c, t
+                # The oldest cycle may have lost its first slots to the wrap - unless the very first
+                # slot is still there, as the file isn't its full size until the ring has wrapped
+                regs = {} if i > 0 or seq == 0 else None
+            if regs is not None:
+                regs.update(((kind, start + j), w) for j, w in enumerate(words))
+        if cycle is not None and regs is not None:
+            yield t0, regs
+
+class ReplayClient:
+    '''
+    Stands in for ModbusTcpClient, answering reads from the registers of the recorded cycle
+    being replayed. Anything that wasn't recorded gets an illegal address exception.
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.registers = {} # (kind, address): word
+        self.timeout = 0
+        self.socket = None
+
+    def connect(self):
+        return True
+
+    def close(self):
+        pass
+
+    def _read(self, kind, address, count, response):
+        try:
+            return response([self.registers[(kind, a)] for a in range(address + 1, address + 1 + count)])
+        except KeyError:
+            return ExceptionResponse(response.function_code, ModbusExceptions.IllegalAddress)
+
+    def read_input_registers(self, address, count=1, unit=1):
+        return self._read('input', address, count, ReadInputRegistersResponse)
+
+    def read_holding_registers(self, address, count=1, unit=1):
+        return self._read('holding', address, count, ReadHoldingRegistersResponse)
+
+    def write_register(self, address, value, unit=1):
+        return ExceptionResponse(0x06, ModbusExceptions.IllegalFunction)
+
+    def write_registers(self, address, values, unit=1):
+        return ExceptionResponse(0x10, ModbusExceptions.IllegalFunction)
+
+    def __str__(self):
+        return f'ReplayClient({self.name})'
+
+def recording_name(group_name):
+    return group_name.replace(':', '_').replace('/', '_') + '.rec'
+
+class Replayer:
+    '''
+    Feeds recordings back through their groups, interleaved by time. speed 1 is real time,
+    bigger is faster and 0 is as fast as we can go. Calls done when it's run out.
+    '''
+    def __init__(self, groups, recordings, speed=1, done=None):
+        self.speed = speed
+        self.done = done
+        self.cycles = 0
+        self._groups = groups
+        self._stream = heapq.merge(*[((t, i, regs) for t, regs in Recording(r).cycles())
+                                     for i, r in enumerate(recordings)], key=lambda c: c[:2])
+        self._next = None
+        self._t0 = None
+
+    def start(self):
+        GLib.idle_add(self._step)
+
+    def _step(self):
+        for _ in range(REPLAY_BATCH):
+            if self._next is None:
+                self._next = next(self._stream, None)
+                if self._next is None:
+                    log.info('Replayed %d cycles', self.cycles)
+                    if self.done is not None:
+                        self.done()
+                    return False
+
+            t, i, regs = self._next
+            if self.speed:
+                now = time.monotonic()
+                if self._t0 is None:
+                    self._t0 = (now, t)
+                wait = self._t0[0] + (t - self._t0[1])/self.speed - now
+                if wait > 0:
+                    GLib.timeout_add(int(wait*1000) + 1, self._step)
+                    return False
+
+            self._groups[i].replay(t, regs)
+            self.cycles += 1
+            self._next = None
+
+        return True # more to do, after dbus has had a look in
+
+# Register discovery
+def _ranges(addresses):
+    # [[lo, hi)] runs of a set of addresses, for saving compactly
+    ranges = []
+    for a in sorted(addresses):
+        if ranges and ranges[-1][1] == a:
+            ranges[-1][1] = a + 1
+        else:
+            ranges.append([a, a + 1])
+    return ranges
+
+class Capabilities:
+    '''
+    Which registers a model answers and the biggest read it's accepted, found by scanning and
+    cached on disk per type code, so the planner only asks for blocks that are known to work.
+
+    scan() reads the spans of the registers we want - close enough together that the planner
+    might read them as one - in max_block chunks, and splits any chunk the device refuses, or
+    doesn't answer at all as some dongles do with reads that are too big, in half until it finds
+    the addresses it won't answer. Then it bisects for the biggest read it'll take over the
+    longest run of good addresses. Only ranges we haven't scanned before are read, so a new
+    register in the map costs a few transactions, not a rescan.
+    '''
+    KINDS = ('input', 'holding')
+
+    def __init__(self, type_code, max_block=MAX_BLOCK):
+        self.type_code = type_code
+        self.max_block = max_block # biggest read that's worked, or what we'll try
+        self.largest = 0
+        self.too_big = None # smallest read that got no answer
+        self.answers = {k: set() for k in self.KINDS}
+        self.scanned = {k: set() for k in self.KINDS}
+
+    @staticmethod
+    def path(state_dir, type_code):
+        return os.path.join(state_dir, f'sungrow-{type_code:04x}.capabilities')
+
+    @classmethod
+    def load(cls, path, type_code):
+        try:
+            with open(path) as f:
+                d = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            log.warning('Ignoring bad capabilities file %s', path, exc_info=True)
+            return None
+
+        caps = cls(type_code, d.get('max_block', MAX_BLOCK))
+        caps.largest = d.get('largest', 0)
+        caps.too_big = d.get('too_big')
+        for k in cls.KINDS:
+            for lo, hi in d.get('answers', {}).get(k, ()):
+                caps.answers[k].update(range(lo, hi))
+            for lo, hi in d.get('scanned', {}).get(k, ()):
+                caps.scanned[k].update(range(lo, hi))
+        return caps
+
+    def save(self, path):
+        d = dict(type_code=self.type_code, max_block=self.max_block, largest=self.largest, too_big=self.too_big,
+                 answers={k: _ranges(v) for k, v in self.answers.items()},
+                 scanned={k: _ranges(v) for k, v in self.scanned.items()})
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(d, f)
+        os.replace(tmp, path)
+
+    def supports(self, kind, lo, hi):
+        answers = self.answers[kind]
+        return all(a in answers for a in range(lo, hi))
+
+    def unscanned(self, regs, max_gap=MAX_GAP):
+        '''[(kind, lo, hi)] spans of regs, with gaps of up to max_gap, that haven't all been scanned'''
+        spans = []
+        for r in sorted(regs, key=lambda r: (r.kind, r.address)):
+            if spans and spans[-1][0] == r.kind and r.address - spans[-1][2] <= max_gap:
+                spans[-1][2] = max(spans[-1][2], r.end)
+            else:
+                spans.append([r.kind, r.address, r.end])
+        return [(kind, lo, hi) for kind, lo, hi in spans
+                if not all(a in self.scanned[kind] for a in range(lo, hi))]
+
+    def _longest_run(self):
+        best = (0, None, 0)
+        for kind, answers in self.answers.items():
+            for lo, hi in _ranges(answers):
+                best = max(best, (hi - lo, kind, lo))
+        return best
+
+    def _chunk(self):
+        # Size to scan in - half the smallest read that got no answer, if there's been one
+        return self.max_block if self.too_big is None else max(1, min(self.max_block, self.too_big//2))
+
+    def scan(self, read, regs, max_gap=MAX_GAP):
+        '''
+        Scan what we haven't yet. read(kind, address, count) returns True if the device answered,
+        False if it refused, or None if it didn't answer at all. If even a single register gets
+        no answer the device has gone, and IOError is raised - what's been scanned so far is kept,
+        so the caller can save it and carry on later. Returns whether anything was read.
+        '''
+        spans = self.unscanned(regs, max_gap)
+        too_big = self.too_big
+        for kind, lo, hi in spans:
+            step = self._chunk()
+            chunks = [(a, min(a + step, hi)) for a in range(lo, hi, step)]
+            while chunks:
+                a, b = chunks.pop()
+                if all(x in self.scanned[kind] for x in range(a, b)):
+                    continue # done before we gave up last time
+                ok = read(kind, a, b - a)
+                if ok:
+                    self.answers[kind].update(range(a, b))
+                    self.largest = max(self.largest, b - a)
+                    self.scanned[kind].update(range(a, b))
+                elif b - a > 1:
+                    if ok is None:
+                        self.too_big = b - a if self.too_big is None else min(self.too_big, b - a)
+                    mid = (a + b)//2
+                    chunks += [(mid, b), (a, mid)]
+                elif ok is None:
+                    # The reads that got no answer on the way here may have been it going too
+                    self.too_big = too_big
+                    raise IOError(f'No response scanning {kind} {a}')
+                else:
+                    self.scanned[kind].add(a)
+
+        if spans and self.largest < self.max_block:
+            # Chunks can fail for being too big as well as for holes, so try bigger reads where
+            # we know every address answers, bisecting between the biggest that's worked and the
+            # smallest that hasn't. Don't plan reads bigger than any that's worked.
+            run, kind, lo = self._longest_run()
+            good = self.largest
+            bad = min(self.max_block, run) + 1
+            if self.too_big is not None:
+                bad = min(bad, self.too_big)
+            while bad - good > 1:
+                size = (good + bad)//2 if bad <= min(self.max_block, run) else bad - 1
+                if read(kind, lo, size):
+                    good = size
+                else:
+                    bad = size
+            self.largest = good
+            self.max_block = self.largest
+        return bool(spans)
+
+class DeviceGroup:
+    '''
+    Polls all the products that share a client with one timer and one combined block plan,
+    so registers that more than one product wants are only read once per tick and requests
+    from different products don't interleave on the socket.
+
+    Each tick only reads the registers in tiers that are due, and the last values of the others
+    are kept in a cache. Static registers are read again whenever a read fails, so they're
+    refreshed when we reconnect.
+
+    With async_io the modbus reads happen on a worker thread and the results are handed back to
+    the main loop with GLib.idle_add, so a sleeping inverter or a dropped dongle can't stop us
+    answering dbus requests while the socket times out.
+
+    Ticks are scheduled against fixed monotonic deadlines so the period doesn't stretch by the
+    time the work takes. If we overrun, the missed ticks are skipped rather than run back to back.
+
+    Groups for several devices can share an executor so they're polled in parallel by a bounded
+    pool of threads. Groups for different unit ids behind the same dongle share its Connection.
+
+    Writes from the dbus are queued with the last value winning, rate limited to one per register
+    per WRITE_INTERVAL, and sent ahead of the reads - straight away if nothing is in flight,
+    otherwise as soon as it finishes. Each one is read back to confirm it.
+
+    With a recorder every block read is saved, so it can be fed back through replay() later.
+    Groups being replayed don't poll on their own timer.
+
+    Products polled adaptively say what interval they'd like after each poll and the fast tier
+    runs at the shortest of them. If that's sooner than the tick already set, it's moved forward.
+
+    With discover_dir the first poll after connecting reads the type code and finds out which of
+    our registers the model answers - from the Capabilities cached in discover_dir, or by
+    scanning - and the plans only read those. Registers it doesn't answer are published as None.
+    '''
+    def __init__(self, client, products, interval_ms=1000, max_gap=MAX_GAP, max_block=MAX_BLOCK, async_io=True,
+                 unit=1, executor=None, connection=None, name=None, recorder=None, timer=True, discover_dir=None):
+        self._conn = connection or Connection(client)
+        self._client = self._conn.client
+        self.unit = unit
+        self._lock = self._conn.lock
+        self.products = list(products)
+        for p in self.products:
+            p.group = self
+        self._interval_ms = interval_ms
+        self._period = interval_ms/1000.0
+        self._timer = None
+        self.max_gap = max_gap
+        self.max_block = max_block
+        self.tiers = dict(TIERS, fast=interval_ms/1000.0)
+        self._plans = {}
+        self._next = {t: 0 for t in self.tiers} # monotonic time each tier is next due
+        self._values = {} # last value of every reg
+        if async_io and executor is None:
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='modbus')
+        self._executor = executor if async_io else None
+        self._pending = None
+        self._deferred = None # (start, due) of a tick that came while _pending was in flight
+        self._failed = False
+        self._writes = {} # reg: (value, time requested)
+        self._written = {} # reg: time last written
+        self._write_blocks = {} # reg: Block for reading it back
+        self._kick_timer = None
+        self.name = name or getattr(client, 'host', str(client))
+        self.perf = Perf()
+        self.lateness = 0 # seconds the last tick ran after its deadline
+        self.recorder = recorder
+        self.discover_dir = discover_dir
+        self.capabilities = None # Capabilities once discovered
+        self._replay_words = None # tier: {(kind, address)} it needs
+
+        self._deadline = time.monotonic()
+        if timer:
+            GLib.idle_add(self._update_robust) # first tick as soon as we're up, then it re-arms itself
+        GLib.timeout_add(PERF_INTERVAL*1000, self._publish_perf)
+
+    @property
+    def period(self):
+        return self._period
+
+    def _arm(self):
+        now = time.monotonic()
+        self._deadline += self.period
+        if self._deadline <= now:
+            missed = int((now - self._deadline)/self.period) + 1
+            log.debug('%s overran, skipping %d ticks', self._client, missed)
+            self._deadline += missed*self.period
+            self.perf.skipped += missed
+
+        self._timer = GLib.timeout_add(max(0, round((self._deadline - now)*1000)), self._update_robust)
+
+    def _adapt(self, start, t, values):
+        wanted = [i for i in (p.poll_interval(values, t) for p in self.products) if i is not None]
+        if not wanted:
+            return
+        period = min(wanted)
+        if period == self._period:
+            return
+        log.debug('%s polling every %.2fs', self.name, period)
+        self._period = self.tiers['fast'] = period
+        if self._timer is not None and self._deadline > start + period:
+            # Faster than the tick we've set - bring it forward
+            GLib.source_remove(self._timer)
+            self._deadline = start
+            self._arm()
+
+    def due(self, now):
+        # Half a tick of slack so timer jitter doesn't push a tier into the next cycle
+        now += self.period/2
+        return frozenset(t for t, n in self._next.items() if n is not None and now >= n)
+
+    def plan(self, tiers):
+        '''
+        Blocks to read for the given set of tiers. Plans are cached as there are only a few combinations.
+        '''
+        blocks = self._plans.get(tiers)
+        if blocks is None:
+            regs = [r for p in self.products for r in p._regs if r.tier in tiers]
+            blocks = self._plans[tiers] = plan_blocks(regs, self.max_gap, self.max_block, capabilities=self.capabilities)
+            log.debug('%s planned %s for %s', self._client, blocks, sorted(tiers))
+
+        return blocks
+
+    def _schedule(self, due, ok, now):
+        for t in due:
+            if ok:
+                period = self.tiers[t]
+                self._next[t] = None if period is None else now + period
+        if not ok:
+            self._next['static'] = 0 # re-read identity when we get back
+            if self.discover_dir is not None:
+                self.capabilities = None # and check it's the same model
+
+    def write(self, reg, value):
+        '''
+        Queue a write to a holding register - if there's already one waiting it's replaced
+        '''
+        self._writes[reg] = (value, time.monotonic())
+        self._kick()
+
+    def _kick(self, from_timer=False):
+        # Send queued writes now rather than waiting for the next tick, if we can
+        if from_timer:
+            self._kick_timer = None
+        if self._executor is None or self._pending is not None or not self._writes:
+            return False # the next tick, or the end of the one in flight, will pick them up
+        if not self._conn.allow(time.monotonic()):
+            return False
+
+        now = time.monotonic()
+        wait = min(self._written.get(r, float('-inf')) for r in self._writes) + WRITE_INTERVAL - now
+        if wait > 0:
+            if self._kick_timer is None:
+                self._kick_timer = GLib.timeout_add(int(wait*1000) + 1, self._kick, True)
+            return False
+
+        self._start(now, frozenset())
+        return False
 
+    def _take_writes(self, now):
+        writes = []
+        for reg, (value, requested) in list(self._writes.items()):
+            if now - self._written.get(reg, float('-inf')) >= WRITE_INTERVAL:
+                writes.append((reg, value, requested))
+                del self._writes[reg]
+                self._written[reg] = now
+        return writes
 
+    def _requeue(self, writes):
+        # Put back writes that didn't happen, unless there's a newer value waiting
+        for reg, value, requested in writes:
+            self._writes.setdefault(reg, (value, requested))
 
+    def _write(self, reg, value, requested, values):
+        # On the worker thread, with the lock held
+        raw = reg.encode(value)
+        if len(raw) == 1:
+            rr = self._client.write_register(reg.address-1, raw[0], unit=self.unit)
+        else:
+            rr = self._client.write_registers(reg.address-1, raw, unit=self.unit)
+        if isinstance(rr, ExceptionResponse):
+            log.warning('%s refused %s = %s: %s', self.name, reg, value, rr)
+            self.perf.write_errors += 1
+            return
+        if rr.isError():
+            raise IOError(f'No response writing {reg}: {rr}')
+
+        block = self._write_blocks.get(reg)
+        if block is None:
+            block = self._write_blocks[reg] = Block(reg.address, reg.end, [reg])
+        values.update(block.decode(read_block(self._client, block, self.unit)))
+        if reg.encode(values[reg]) != raw:
+            log.warning('%s wrote %s = %s but read back %s', self.name, reg, value, values[reg])
+            self.perf.write_errors += 1
+        else:
+            self.perf.writes += 1
+            self.perf.write_latency.record(time.monotonic() - requested)
+
+    def _scan_read(self, kind, address, count):
+        # True if it answered, False if it refused, None if there was no answer - see Capabilities.scan()
+        read = self._client.read_holding_registers if kind == 'holding' else self._client.read_input_registers
+        try:
+            rr = read(address-1, count, unit=self.unit)
+        except IOError:
+            rr = None
+        if isinstance(rr, ExceptionResponse):
+            return False
+        if rr is None or rr.isError():
+            log.debug('%s no response scanning %s %d+%d', self.name, kind, address, count)
+            self._conn.drop() # whatever it sends late mustn't be taken for the next answer
+            return None
+        return True
+
+    def _discover(self):
+        # On the worker thread with the lock held
+        type_code = _check(self._client.read_input_registers(PROBE_ADDRESS-1, 1, unit=self.unit),
+                           f'type code at {PROBE_ADDRESS}')[0]
+        path = Capabilities.path(self.discover_dir, type_code)
+        caps = Capabilities.load(path, type_code) or Capabilities(type_code, self.max_block)
+        regs = [r for p in self.products for r in p._regs]
+        try:
+            scanned = caps.scan(self._scan_read, regs, self.max_gap)
+        except:
+            try:
+                caps.save(path) # so the next try carries on from here
+            except OSError:
+                log.warning('Can\'t save %s', path, exc_info=True)
+            raise
+        if scanned:
+            log.info('%s type %04x answers reads of up to %d registers', self.name, type_code, caps.max_block)
+            try:
+                caps.save(path)
+            except OSError:
+                log.warning('Can\'t save %s', path, exc_info=True)
+
+        unsupported = [r for r in regs if not caps.supports(r.kind, r.address, r.end)]
+        if unsupported:
+            log.warning('%s type %04x doesn\'t answer %s - leaving them out', self.name, type_code, unsupported)
+        self._plans = {}
+        self.capabilities = caps
+
+    def poll(self, due, writes=()):
+        '''
+        Send any writes, then read all the registers in the due tiers for all products in as few
+        transactions as possible. Returns (time read, {reg: value}). Safe to call from the worker
+        thread - it only touches the client, and the plans while the main loop is waiting for us.
+        '''
+        perf = self.perf
+        values = {}
+        decode = 0
+        read = [] # (block, words) for the recorder
+        with self._lock:
+            try:
+                if self._conn.stale(time.monotonic()):
+                    self._conn.probe(self.unit)
+
+                if due and self.discover_dir is not None and self.capabilities is None:
+                    self._discover()
+                blocks = self.plan(due)
+
+                for reg, value, requested in writes:
+                    self._write(reg, value, requested, values)
+
+                with diagnostics.stage('poll'):
+                    results = read_blocks(self._client, blocks, self.unit)
+                with diagnostics.stage('decode'):
+                    for block, (words, seconds) in zip(blocks, results):
+                        perf.block(block.start).record(seconds)
+                        t1 = time.monotonic()
+                        values.update(block.decode(words))
+                        decode += time.monotonic() - t1
+                        read.append((block, words))
+                t = time.monotonic()
+                if self.recorder is not None and read:
+                    self.recorder.record(t, read)
+            except DeviceError:
+                perf.errors += 1
+                raise
+            except:
+                perf.timeouts += 1
+                self._conn.drop()
+                raise
+
+        perf.transactions = len(blocks) + 2*len(writes)
+        perf.transactions_total += perf.transactions
+        perf.decode.record(decode)
+        return t, values
+
+    def replay(self, t, registers):
+        '''
+        Publish a recorded cycle read at time t, with registers {(kind, address): word}. The
+        tiers that were read in it are read again from a ReplayClient, so the blocks don't have
+        to match the ones recorded.
+        '''
+        if self._replay_words is None:
+            self._replay_words = {tier: {(r.kind, a) for p in self.products for r in p._regs if r.tier == tier
+                                         for a in range(r.address, r.end)} for tier in self.tiers}
+        self._client.registers = registers
+        due = frozenset(tier for tier, words in self._replay_words.items() if words and words <= registers.keys())
+        if not self._values and len(due) < sum(1 for words in self._replay_words.values() if words):
+            return # wait for a full cycle to start from
+        start = time.monotonic()
+        try:
+            _, values = self.poll(due)
+        except IOError as e:
+            log.warning('%s: %s', self.name, e)
+            values = None
+        self._publish(start, due, t, values)
+
+    def _update_robust(self):
+        self._timer = None
+        now = time.monotonic()
+        self.lateness = now - self._deadline
+        self.perf.lateness.record(max(0, self.lateness))
+        start = self._deadline
+        due = self.due(now)
+        self._arm() # before the cycle, which may move it if it speeds up
+        if self._pending is not None:
+            # Previous read or write still in flight - run this tick when it's done, rather than
+            # queue up another one behind it. If it's still stuck by the next tick, that's skipped.
+            if self._deferred is not None:
+                log.debug('%s still busy, skipping cycle', self._client)
+                self.perf.skipped += 1
+                due |= self._deferred[1]
+            self._deferred = (start, due)
+        elif not self._conn.allow(now):
+            self.perf.circuit_skips += 1
+        else:
+            self._start(start, due)
+
+        return False # _arm() has added the next one
+
+    def _start(self, start, due):
+        '''
+        Start a cycle reading the due tiers, with any writes that are ready. With no tiers due it's
+        just the writes.
+        '''
+        writes = self._take_writes(time.monotonic())
+        if self._executor is None:
+            self._done(start, due, writes, *self._result(lambda: self.poll(due, writes)))
+        else:
+            self._pending = self._conn.submit(self._executor, self.poll, due, writes)
+            self._pending.add_done_callback(lambda f: GLib.idle_add(self._read_done, f, start, due, writes))
+
+    def _read_done(self, future, start, due, writes):
+        # Back on the main loop
+        self._pending = None
+        self._done(start, due, writes, *self._result(future.result))
+        deferred, self._deferred = self._deferred, None
+        if deferred is not None:
+            if self._conn.allow(time.monotonic()):
+                self._start(*deferred)
+            else:
+                self.perf.circuit_skips += 1
+        self._kick() # anything that came in while we were busy
+        return False # one shot idle callback
+
+    def _result(self, poll):
+        '''
+        Returns (time, values, alive) from poll. values is None if it failed, alive is whether the
+        device answered at all.
+        '''
+        try:
+            t, values = poll()
+            return t, values, True
+        except DeviceError as e:
+            log.warning('%s: %s', self.name, e)
+            return None, None, True
+        except:
+            if self._conn.failures == 0:
+                log.exception('Exception reading %s', self._client)
+            else:
+                log.debug('%s still failing', self._client, exc_info=True)
+            return None, None, False
+
+    def _done(self, start, due, writes, t, values, alive):
+        self._conn.record(alive, time.monotonic())
+        if values is None:
+            self._requeue(writes)
+        if due:
+            self._publish(start, due, t, values)
+        elif values is not None:
+            self._values.update(values)
+            for p in self.products:
+                p._publish_writes(values)
+
+    def _publish(self, start, due, t, values):
+        ok = values is not None
+        if ok:
+            self._values.update(values)
+            values = self._values
+            if self._failed:
+                self.perf.reconnects += 1
+            if 'fast' in due:
+                self._adapt(start, t, values)
+        self._failed = not ok
+        self._schedule(due, ok, start)
+
+        t0 = time.monotonic()
+        with diagnostics.stage('publish'), contextlib.ExitStack() as publishers:
+            for p in self.products:
+                publishers.enter_context(p._publisher)
+            for p in self.products:
+                p._update_robust(values, t)
+            derived.run() # our products' derived values, in the same ItemsChanged
+        t1 = time.monotonic()
+
+        self.perf.publish.record(t1 - t0)
+        self.perf.cycle.record(t1 - start)
+        self.perf.cycles += 1
+
+    def _publish_perf(self):
+        for p in self.products:
+            p.publish_perf(self.perf)
+        return True
+
+
+
+# Process per device
+SLOT_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else '/tmp' # RAM, so the samples don't touch the flash
+SLOT_CHECK = 50 # ms between looking for new samples
+RESTART_DELAY = 1 # seconds before restarting a crashed worker, doubling each time it crashes quickly
+RESTART_MAX = 60 # and a worker that's been up this long resets it
+
+class SampleSlot:
+    '''
+    Shared memory, in a file in SLOT_DIR, that one worker process writes each cycle's decoded
+    values into and the main process reads them from, without pickling anything.
+
+    The regs are laid out in a fixed order known to both sides - a double each, NaN if it wasn't
+    read this cycle, or a flag byte and the bytes for text. The worker guards each sample with a seqlock: the
+    sequence number is odd while it's writing, so the reader copies the sample out and only uses
+    it if the number was even and the same before and after.
+
+    The main process writes the poll period it wants, and queued writes into a mailbox per
+    writeable register - value and time first, then bumping its count.
+    '''
+    CONTROL = struct.Struct('<d') # period, written by the main process
+    # seq, time read, due tiers, ok, then the perf counters in COUNTERS
+    COUNTERS = ('transactions', 'transactions_total', 'timeouts', 'errors', 'skipped', 'circuit_skips', 'writes',
+                'write_errors')
+    HEADER = struct.Struct(f'<QdII{len(COUNTERS)}Q')
+    MAILBOX = struct.Struct('<Idd') # count, value, time requested
+
+    def __init__(self, path, regs, create=False):
+        self.path = path
+        self.regs = list(regs)
+        self.writeable = [r for r in self.regs if r.writeable]
+        self.tiers = list(TIERS)
+        self._values = struct.Struct('<' + ''.join(f'{2*r.width + 1}s' if r.text else 'd' for r in self.regs))
+        self._header_at = self.CONTROL.size
+        self._values_at = self._header_at + self.HEADER.size
+        self._mailbox_at = self._values_at + self._values.size
+        size = self._mailbox_at + self.MAILBOX.size*len(self.writeable)
+
+        fd = os.open(path, os.O_RDWR | (os.O_CREAT | os.O_TRUNC if create else 0), 0o600)
+        try:
+            if create:
+                os.ftruncate(fd, size)
+            self._mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.seq = self.HEADER.unpack_from(self._mm, self._header_at)[0]
+        self.seq += self.seq & 1 # a worker that died mid-write leaves it odd
+        # Last count seen, or sent - a restarted worker doesn't repeat the writes its predecessor did
+        self._mail = [self.MAILBOX.unpack_from(self._mm, self._mailbox_at + i*self.MAILBOX.size)[0]
+                      for i in range(len(self.writeable))]
+        self._period = None
+
+    # Worker side
+
+    def publish(self, t, due, values, perf):
+        '''Write one cycle's sample. values is {reg: value} or None if the poll failed'''
+        mm = self._mm
+        self.seq += 1
+        struct.pack_into('<Q', mm, self._header_at, self.seq)
+        if values is not None:
+            fields = []
+            for r in self.regs:
+                v = values.get(r)
+                if r.text:
+                    fields.append(b'' if v is None else b'\1' + v.encode('utf-8'))
+                else:
+                    fields.append(math.nan if v is None else v)
+            self._values.pack_into(mm, self._values_at, *fields)
+        bits = sum(1 << self.tiers.index(tier) for tier in due)
+        counters = [getattr(perf, c) for c in self.COUNTERS]
+        self.seq += 1
+        self.HEADER.pack_into(mm, self._header_at, self.seq, t or 0, bits, values is not None, *counters)
+
+    def period(self):
+        return self.CONTROL.unpack_from(self._mm, 0)[0]
+
+    def writes(self):
+        '''[(reg, value, time requested, count)] asked for and not yet sent()'''
+        writes = []
+        for i, reg in enumerate(self.writeable):
+            count, value, requested = self.MAILBOX.unpack_from(self._mm, self._mailbox_at + i*self.MAILBOX.size)
+            if count != self._mail[i]:
+                writes.append((reg, value, requested, count))
+        return writes
+
+    def sent(self, writes):
+        for reg, _, _, count in writes:
+            self._mail[self.writeable.index(reg)] = count
+
+    # Main process side
+
+    def set_period(self, period):
+        if period != self._period:
+            self._period = period
+            self.CONTROL.pack_into(self._mm, 0, period)
+
+    def write(self, reg, value, requested):
+        i = self.writeable.index(reg)
+        at = self._mailbox_at + i*self.MAILBOX.size
+        self._mail[i] = (self._mail[i] + 1) & 0xffffffff
+        struct.pack_into('<dd', self._mm, at + 4, value, requested)
+        struct.pack_into('<I', self._mm, at, self._mail[i])
+
+    def read(self, last):
+        '''
+        The sample after sequence number last, as (seq, t, due, values, counters) - values is None
+        if the poll failed. Returns None if there isn't a new one, or it's being written.
+        '''
+        mm = self._mm
+        seq = struct.unpack_from('<Q', mm, self._header_at)[0]
+        if seq == last or seq & 1:
+            return None
+        data = mm[self._header_at:self._mailbox_at]
+        if struct.unpack_from('<Q', mm, self._header_at)[0] != seq:
+            return None # caught it mid-write, try again next time
+
+        _, t, bits, ok, *counters = self.HEADER.unpack_from(data)
+        due = frozenset(tier for i, tier in enumerate(self.tiers) if bits & (1 << i))
+        values = None
+        if ok:
+            values = {}
+            for r, v in zip(self.regs, self._values.unpack_from(data, self.HEADER.size)):
+                if r.text:
+                    if v[:1] == b'\1':
+                        values[r] = v[1:].split(b'\0', 1)[0].decode('utf-8', 'replace')
+                elif v == v: # not NaN
+                    values[r] = int(v) if r.scale.__class__ is int else v
+        return seq, t, due, values, dict(zip(self.COUNTERS, counters))
+
+    def close(self):
+        self._mm.close()
+
+
+class _Regs:
+    # Stands in for the products in a worker's DeviceGroup, which only needs their registers
+    def __init__(self, regs):
+        self._regs = regs
+        self.group = None
+
+def poll_worker(slot_path, regs, device, interval_ms, unit, name, level, discover_dir, record_path, record_size):
+    '''
+    The polling loop for one group, in its own process - see Supervisor. It's the same
+    DeviceGroup polling as in the main process, but on a plain loop with no dbus.
+    '''
+    logging.basicConfig(level=level, format=f'%(levelname)s:{name}:%(message)s')
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # the main process handles ^C and stops us
+    parent = os.getppid()
+    slot = SampleSlot(slot_path, regs)
+    recorder = Recorder(record_path, record_size) if record_path else None
+    group = DeviceGroup(make_client(device), [_Regs(slot.regs)], interval_ms, async_io=False, unit=unit, name=name,
+                        recorder=recorder, timer=False, discover_dir=discover_dir)
+    conn = group._conn
+    deadline = time.monotonic()
+    while os.getppid() == parent:
+        period = slot.period()
+        if period > 0:
+            group._period = group.tiers['fast'] = period
+
+        now = time.monotonic()
+        if conn.allow(now):
+            due = group.due(now)
+            mail = slot.writes()
+            writes = [w[:3] for w in mail]
+            t, values, alive = group._result(lambda: group.poll(due, writes))
+            conn.record(alive, time.monotonic())
+            if values is not None:
+                slot.sent(mail) # otherwise they're tried again next time
+            group._schedule(due, values is not None, deadline)
+            slot.publish(t, due, values, group.perf)
+        else:
+            group.perf.circuit_skips += 1
+
+        deadline += group.period
+        now = time.monotonic()
+        if deadline <= now:
+            missed = int((now - deadline)/group.period) + 1
+            deadline += missed*group.period
+            group.perf.skipped += missed
+        time.sleep(deadline - now)
+
+class Supervisor:
+    '''
+    Polls each group in its own worker process, for when one device's trouble shouldn't hold
+    up the others or take the service down. The groups and products in this process don't poll -
+    samples come back through a SampleSlot per group, which is checked every SLOT_CHECK ms and
+    published through the group as usual. Writes and the adaptive poll period go the other way.
+
+    Workers that die are restarted, after RESTART_DELAY doubling up to RESTART_MAX if they keep
+    dying, while the dbus services stay up showing the device disconnected.
+    '''
+    def __init__(self, groups, devices, level='INFO', record_dir=None, record_size=RECORDING_SIZE):
+        self._mp = multiprocessing.get_context('spawn') # forking the main loop and dbus isn't safe
+        self.workers = []
+        for i, (g, d) in enumerate(zip(groups, devices)):
+            regs = [r for p in g.products for r in p._regs]
+            path = os.path.join(SLOT_DIR, f'sungrow-dbus-{os.getpid()}-{i}')
+            record_path = os.path.join(record_dir, recording_name(g.name)) if record_dir else None
+            args = (path, regs, d, g._interval_ms, g.unit, g.name, level, g.discover_dir,
+                    record_path, record_size*1024*1024)
+            w = {'group': g, 'slot': SampleSlot(path, regs, create=True), 'args': args, 'process': None,
+                 'seq': 0, 'started': 0, 'delay': RESTART_DELAY, 'restart_at': 0}
+            self.workers.append(w)
+            self._start(w)
+        GLib.timeout_add(SLOT_CHECK, self._check)
+
+    def _start(self, w):
+        g = w['group']
+        p = w['process'] = self._mp.Process(target=poll_worker, args=w['args'], name=f'sungrow {g.name}', daemon=True)
+        p.start()
+        w['started'] = time.monotonic()
+        log.info('%s polling in process %d', g.name, p.pid)
+
+    def _check(self):
+        now = time.monotonic()
+        for w in self.workers:
+            g, slot = w['group'], w['slot']
+            sample = slot.read(w['seq'])
+            if sample is not None:
+                w['seq'], t, due, values, counters = sample
+                if values is None and not g._failed:
+                    log.warning('%s not answering', g.name)
+                perf = g.perf
+                for c, v in counters.items():
+                    setattr(perf, c, v)
+                g._publish(t or now, due, t, values)
+                slot.set_period(g.period)
+
+            writes = g._take_writes(now)
+            for reg, value, requested in writes:
+                slot.write(reg, value, requested)
+
+            p = w['process']
+            if p.is_alive():
+                continue
+            if w['restart_at'] == 0:
+                log.error('%s worker %d died with %s', g.name, p.pid, p.exitcode)
+                g._publish(now, frozenset(), None, None) # disconnected until it's back
+                if now - w['started'] > RESTART_MAX:
+                    w['delay'] = RESTART_DELAY
+                w['restart_at'] = now + w['delay']
+                w['delay'] = min(RESTART_MAX, 2*w['delay'])
+            elif now >= w['restart_at']:
+                w['restart_at'] = 0
+                self._start(w)
+        return True
+
+    def stop(self):
+        for w in self.workers:
+            w['process'].terminate()
+        for w in self.workers:
+            w['process'].join(MODBUS_TIMEOUT)
+            w['slot'].close()
+            try:
+                os.unlink(w['slot'].path)
+            except OSError:
+                pass
+
+
+# Sungrow work state (5038): Victron /StatusCode
+WORK_STATES = {
+    0x0000: 7, # run
+    0x8000: 8, # stop
+    0x1300: 8, # key stop
+    0x1500: 10, # emergency stop
+    0x1400: 8, # standby
+    0x1200: 8, # initial standby
+    0x1600: 0, # starting
+    0x9100: 7, # alarm run
+    0x8100: 7, # derating run
+    0x8200: 7, # dispatch run
+    0x5500: 10, # fault
+    0x2500: 10, # communication fault
+}
+STANDBY_STATES = {0x1400, 0x1200}
 
 class SungrowInverter(SungrowProduct):
-    def __init__(self, client, servicename, deviceinstance):
-        super().__init__(client, 'Sungrow Inverter', servicename, deviceinstance)
+    lifetime_path = '/Ac/Energy/Forward'
+    site_sign = 1
+
+    def __init__(self, client, servicename, deviceinstance, bus=None, state_dir=None):
+        super().__init__(client, 'Sungrow Inverter', servicename, deviceinstance, bus, state_dir)
     
         # Fixed values
-        maxpower = 10 # self.read(XXX)
-        self._dbusservice.add_path('/Ac/MaxPower', maxpower)
+        self += Reg('/Serial', 4990, width=10, text=True, tier='static')
+        self += Reg('/Ac/MaxPower', 5001, 'W', 100, tier='static') # Nominal active power, 0.1kW
         position = 0 # where it's connected to the inverter. 0=AC input 1; 1=AC output; 2=AC input 2
         self._dbusservice.add_path('/Position', position)
 
-        self += '/Ac/Energy/Forward', 'kWh', 5004 #Total produced energy over all phases = Total power yields
-        self += '/Ac/Power', 'W', 5009 # Total apparent power
-        #        self += '/Ac/PowerLimit', 'W' # writeable # TODO
-        self += '/StatusCode', ''
+        self += Reg('/Ac/Energy/Forward', 5004, 'kWh', width=2, tier='slow') #Total produced energy over all phases = Total power yields
+        self += Reg('/Ac/Power', 5031, 'W', width=2) # Total active power
+        # Power limitation adjustment, 0.1kW. ESS sets this for zero export.
+        self += Reg('/Ac/PowerLimit', 5039, 'W', 100, tier='slow', kind='holding', writeable=True)
+        self += Reg('/StatusCode', 5038) # Work state, mapped to Victron's codes in _update
         self += '/FroniusDeviceType',''
 
         for phase in range (0,3):
             p = phase + 1
-            self += f'/Ac/L{p}/Current', 'A AC', 5022+phase, 0.1
+            self += Reg(f'/Ac/L{p}/Current', 5022+phase, 'A AC', 0.1)
             self += f'/Ac/L{p}/Energy/Forward', 'kWh'
             self += f'/Ac/L{p}/Power', 'W'
-            self += f'/Ac/L{p}/Voltage', 'V AC', 5019+phase, 0.1
+            self += Reg(f'/Ac/L{p}/Voltage', 5019+phase, 'V AC', 0.1)
+
+        # Worked out by the DerivedStage
+        self += '/Ac/PowerFactor', ''
+        self += '/Ac/Imbalance', '%' # largest difference of a phase's power from the mean
+        self += '/Site/NetPower', 'W' # all the inverters' power less all the meters'
+
+        self._work_state = next(r for r in self._regs if r.path == '/StatusCode')
 
         #for path, settings in self._paths.items():
         #    self._dbusservice.add_path(
         #        path, settings['initial'], writeable=True, onchangecallback=self._handlechangedvalue)
 
-        self.phase_energies = [0,0,0]            
+    def standby(self, values):
+        return values.get(self._work_state) in STANDBY_STATES
 
-    def _update(self, s):
-        interval_sec = self._interval_ms/1000.0
+    def _limit(self, reg, value):
+        if reg.path == '/Ac/PowerLimit':
+            if value < 0:
+                raise ValueError('a power limit can\'t be negative')
+            max_power = self._dbusservice['/Ac/MaxPower'] # 0 until we know it
+            if max_power and value > max_power:
+                value = max_power # no limit
+        return value
+
+    def _update(self, s, values, t):
         # HEY KB - for some reason the power in venus doesn't marry up with - basically anything in the Winet GUI
         # check this as it may be lying to us?!
 
-        s['/Ac/Power'] = roundu(self.read(5031),1,'W')
-        s['/Ac/Energy/Forward'] = roundu(self.read(5004),1,'kWHr')
-        d = self.read(5019, 6)
+        s['/Ac/Power'] = roundu(values['/Ac/Power'],1,'W')
+        s['/Ac/Energy/Forward'] = roundu(values['/Ac/Energy/Forward'],1,'kWHr')
+        state = values['/StatusCode']
+        s['/StatusCode'] = None if state is None else WORK_STATES.get(state, 10)
+        volts = []
+        amps = []
         for phase in range(3):
             p = phase + 1
-            v = d[phase]*0.1 # Volts
-            i = d[phase + 3]*0.1 # Amps
-            phase_power =  v * i # W
-            self.phase_energies[phase] += phase_power * interval_sec/3600.0/1000 # kWh
+            v = values[f'/Ac/L{p}/Voltage'] # Volts
+            i = values[f'/Ac/L{p}/Current'] # Amps
+            volts.append(v)
+            amps.append(i)
 
             s[f'/Ac/L{p}/Voltage'] = roundu(v, 1,'V')
             s[f'/Ac/L{p}/Current'] = roundu(i, 1,'A')
-            s[f'/Ac/L{p}/Power'] = roundu(phase_power, 1,'W')
-            s[f'/Ac/L{p}/Energy/Forward'] =  roundu(self.phase_energies[phase],1,'kWHr')
-
-
 
+        # Phase power is volts times amps, done with everyone else's
+        derived.sample(self._row, t, values['/Ac/Power'], volts=volts, amps=amps)
         return True
-
-    def _handlechangedvalue(self, path, value):
-        logging.debug("someone else updated %s to %s" % (path, value))
-        return True # accept the change
     
 class SungrowMeter(SungrowProduct):
-    def __init__(self, client, servicename, deviceinstance):
-        super().__init__(client, 'Sungrow Meter', servicename, deviceinstance)    
+    site_sign = -1
+
+    def __init__(self, client, servicename, deviceinstance, bus=None, state_dir=None):
+        super().__init__(client, 'Sungrow Meter', servicename, deviceinstance, bus, state_dir)    
         # Fixed values
 
         self._dbusservice.add_path('/DeviceType', 'Internal meter')
 
-        self += '/Ac/Energy/Forward', 'kWh', 5004 # Bought energy
-        self += '/Ac/Energy/Reverse', 'kWh', 5004 # Sold energy
-        self += '/Ac/Power', 'W', 5009 # Total apparent power
-        #        self += '/Ac/PowerLimit', 'W' # writeable # TODO
+        self += Reg('/Ac/Energy/Forward', 5099, 'kWh', 0.1, width=2, tier='slow') # Bought energy
+        self += Reg('/Ac/Energy/Reverse', 5095, 'kWh', 0.1, width=2, tier='slow') # Sold energy
+        self += Reg('/Ac/Power', 5083, 'W', width=2, signed=True) # Meter active power
         self += '/StatusCode', ''
 
         for phase in range (0,3):
             p = phase + 1
-            self += f'/Ac/L{p}/Current', 'A AC', 5022+phase, 0.1
+            self += f'/Ac/L{p}/Current', 'A AC' # not supplied
             self += f'/Ac/L{p}/Energy/Forward', 'kWh'
-            self += f'/Ac/L{p}/Power', 'W'
-            self += f'/Ac/L{p}/Voltage', 'V AC', 5019+phase, 0.1
+            self += Reg(f'/Ac/L{p}/Power', 5085+2*phase, 'W', width=2, signed=True)
+            self += f'/Ac/L{p}/Voltage', 'V AC' # not supplied
 
-        self.phase_energies = [0,0,0]            
+        self += '/Ac/Imbalance', '%'
+        self += '/Site/NetPower', 'W'
 
+    def _update(self, s, values, t):
+        s['/Ac/Power'] = roundu(values['/Ac/Power'],1,'W') # W
 
-    def _update(self, s):
-        interval_sec = self._interval_ms/1000.0
-        
-        d = self.read(5083, n=5104-5083)
-        # Every second one is rubbish
-        d = d[::2]
-        s['/Ac/Power'] = roundu(d[0],1,'W') # W
-        log.debug('/Ac/Power %s', s['/Ac/Power'])
+        s['/Ac/Energy/Forward'] = roundu(values['/Ac/Energy/Forward'],1,'kwHr') # Total import energy - kWh
+        s['/Ac/Energy/Reverse'] = roundu(values['/Ac/Energy/Reverse'],1,'kwHr') # total export energy - kWh
 
-        s['/Ac/Energy/Forward'] = roundu(d[8]*0.1,1,'kwHr') # Total import energy - kWh
-        s['/Ac/Energy/Reverse'] = roundu(d[6]*0.1,1,'kwHr') # total export energy - kWh
-
-        dvolts = self.read(5019, 6)
-        pd = d[1:] # phase data
+        powers = []
         for phase in range(3):
             p = phase + 1
             v = 0 # not supplied
             i = 0 # not supplied
-            phase_power = pd[phase] # W
-            self.phase_energies[phase] += phase_power * interval_sec/3600.0/1000# kWh
+            powers.append(values[f'/Ac/L{p}/Power']) # W
 
             s[f'/Ac/L{p}/Voltage'] = roundu(v, 1,'V')
             s[f'/Ac/L{p}/Current'] = roundu(i, 1,'A')
-            s[f'/Ac/L{p}/Power'] = roundu(phase_power, 1,'W')
-            s[f'/Ac/L{p}/Energy/Forward'] =  roundu(self.phase_energies[phase],1,'kwHr')
-
-
 
+        derived.sample(self._row, t, values['/Ac/Power'], watts=powers)
         return True
 
-    def _handlechangedvalue(self, path, value):
-        logging.debug("someone else updated %s to %s" % (path, value))
-        return True # accept the change
-
 
 # === All code below is to simply run it from the commandline for debugging purposes ===
 
@@ -246,41 +2897,202 @@ class SungrowMeter(SungrowProduct):
 
 
 
+# role: (product class, service name prefix)
+ROLES = {
+    'inverter': (SungrowInverter, 'com.victronenergy.pvinverter'),
+    'meter': (SungrowMeter, 'com.victronenergy.grid'),
+}
+
+def load_devices(args):
+    '''
+    Device settings from the config file, or the inverter and meter on --host if there isn't one.
+
+    The config file has a section per device, e.g.
+    [roof]
+    role = inverter
+    host = 192.168.20.23
+    unit = 1
+    deviceinstance = 0
+
+    transport is one of TRANSPORTS - for serial, host is the serial device and there's a
+    baudrate instead of a port. window is how many requests the tcp transport has in flight.
+    '''
+    if not args.config:
+        common = dict(host=args.host, port=args.port, unit=args.unit, deviceinstance=0, transport=args.transport,
+                      window=args.window, baudrate=args.baudrate)
+        return [
+            dict(common, name='sungrow01', role='inverter'),
+            dict(common, name='sungrow01', role='meter'),
+        ]
+
+    config = configparser.ConfigParser()
+    if not config.read(args.config):
+        raise SystemExit(f'Can\'t read config file {args.config}')
+
+    devices = []
+    for i, name in enumerate(config.sections()):
+        c = config[name]
+        role = c.get('role', 'inverter')
+        if role not in ROLES:
+            raise SystemExit(f'[{name}] unknown role {role!r} - should be one of {", ".join(ROLES)}')
+        devices.append(dict(
+            name=name,
+            role=role,
+            host=c['host'],
+            port=c.getint('port', 502),
+            unit=c.getint('unit', 1),
+            deviceinstance=c.getint('deviceinstance', i),
+            servicename=c.get('servicename'),
+            transport=c.get('transport', 'pymodbus'),
+            window=c.getint('window', PIPELINE_WINDOW),
+            baudrate=c.getint('baudrate', SERIAL_BAUDRATE),
+        ))
+        if devices[-1]['transport'] not in TRANSPORTS:
+            raise SystemExit(f'[{name}] unknown transport {devices[-1]["transport"]!r} - should be one of {", ".join(TRANSPORTS)}')
+    return devices
+
+def start_devices(devices, interval_ms=1000, workers=None, async_io=True, state_dir=None, record_dir=None,
+                  record_size=RECORDING_SIZE, replay=False, min_interval_ms=None, discover=False, history=0,
+                  processes=False):
+    '''
+    Create the products and poll them in groups - one group per unit id per dongle, all sharing
+    one connection per dongle and one bounded pool of worker threads. Returns the groups.
+
+    With record_dir each group records its raw registers there. With replay the groups don't
+    poll at all and each gets a ReplayClient for a Replayer to drive.
+
+    With min_interval_ms the products are polled adaptively, between that and the idle interval.
+    With discover each group finds out which registers its model answers, cached in state_dir.
+    With history each product keeps that many samples of its measured paths - see enable_history().
+    With processes each group is polled in its own worker process by a Supervisor, returned as well.
+    '''
+    connections = {} # (host, port): Connection, or (host, port, unit) when replaying
+    products = {} # (host, port, unit): [products]
+    for d in devices:
+        key = (d['host'], d['port'])
+        ckey = key + (d['unit'],) if replay else key
+        if ckey not in connections:
+            if replay:
+                client = ReplayClient('{}:{}/{}'.format(*ckey))
+            else:
+                client = make_client(d)
+            connections[ckey] = Connection(client)
+        client = connections[ckey].client
+
+        cls, prefix = ROLES[d['role']]
+        servicename = d.get('servicename') or f'{prefix}.{d["name"]}'
+        product = cls(client, servicename, d['deviceinstance'], state_dir=state_dir)
+        if history:
+            product.enable_history(history)
+        if min_interval_ms:
+            product.adaptive = AdaptiveRate(interval_ms/1000.0, min_interval_ms/1000.0)
+        products.setdefault(key + (d['unit'],), []).append(product)
+
+    processes = processes and not replay
+    executor = None
+    if async_io and not replay and not processes:
+        executor = ThreadPoolExecutor(max_workers=workers or len(connections), thread_name_prefix='modbus')
+
+    groups = []
+    group_devices = [] # the settings of a device in each group, for its worker
+    for (host, port, unit), ps in products.items():
+        conn = connections[(host, port, unit) if replay else (host, port)]
+        d = next(d for d in devices if (d['host'], d['port'], d['unit']) == (host, port, unit))
+        # From the settings rather than the client, so a replay finds the recording under the same name
+        name = f'{host}/{unit}' if d.get('transport') == 'serial' else f'{host}:{port}/{unit}'
+        recorder = None
+        if record_dir and not processes:
+            recorder = Recorder(os.path.join(record_dir, recording_name(name)), record_size*1024*1024)
+        polled = not replay and not processes
+        groups.append(DeviceGroup(conn.client, ps, interval_ms, async_io=async_io and polled, unit=unit,
+                                  executor=executor, connection=conn, name=name, recorder=recorder,
+                                  timer=polled, discover_dir=state_dir if discover and not replay else None))
+        group_devices.append(d)
+
+    if processes:
+        return groups, Supervisor(groups, group_devices, diagnostics.level, record_dir, record_size)
+    return groups
+
 def main():
-    logging.basicConfig(level=logging.DEBUG)
+    parser = argparse.ArgumentParser(description='Sungrow inverter and meter dbus service')
+    parser.add_argument('-c', '--config', help='config file listing the devices to poll - see load_devices()')
+    parser.add_argument('--host', default='192.168.20.23', help='inverter address, if there\'s no config file')
+    parser.add_argument('--port', type=int, default=502)
+    parser.add_argument('--unit', type=int, default=1)
+    parser.add_argument('--transport', choices=TRANSPORTS, default='pymodbus',
+                        help='how to talk modbus - for serial, --host is the serial device')
+    parser.add_argument('--window', type=int, default=PIPELINE_WINDOW, help='requests in flight with --transport tcp')
+    parser.add_argument('--baudrate', type=int, default=SERIAL_BAUDRATE, help='with --transport serial')
+    parser.add_argument('--interval', type=int, default=1000, help='poll interval, ms')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='poll faster when the power is moving and slower when it isn\'t or the inverter is asleep')
+    parser.add_argument('--min-interval', type=int, default=round(ADAPT_MIN_INTERVAL*1000),
+                        help='fastest adaptive poll interval, ms')
+    parser.add_argument('--workers', type=int, help='modbus worker threads (default one per dongle)')
+    parser.add_argument('--sync-io', action='store_true', help='do modbus reads on the main loop')
+    parser.add_argument('--processes', action='store_true',
+                        help='poll each device in its own worker process, restarted if it crashes')
+    parser.add_argument('--perf-textfile', help='write performance counters to this node_exporter textfile')
+    parser.add_argument('--state-dir', default=STATE_DIR, help='where to keep the energy counters between restarts')
+    parser.add_argument('--discover', action='store_true',
+                        help='scan for the registers each model answers (cached in --state-dir) and only read those')
+    parser.add_argument('--history', type=int, default=0, metavar='SAMPLES',
+                        help=f'keep this many samples of each measured path for /Stats and GetHistory, e.g. {HISTORY_SAMPLES}')
+    parser.add_argument('--log-level', choices=LOG_LEVELS, default='INFO',
+                        help='change it while running with /Mgmt/LogLevel or SIGUSR2 (toggles DEBUG)')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile from the start - toggle it while running with /Mgmt/Profiling or SIGUSR1')
+    parser.add_argument('--profile-dir', default=PROFILE_DIR, help='where to write profiles')
+    parser.add_argument('--profile-interval', type=int, default=PROFILE_INTERVAL, help='seconds between profile dumps')
+    parser.add_argument('--record', metavar='DIR', help='record the raw registers read to a ring file per device in DIR')
+    parser.add_argument('--record-size', type=int, default=RECORDING_SIZE, help='MB per recording')
+    parser.add_argument('--replay', metavar='DIR', help='publish recordings from DIR instead of polling the devices')
+    parser.add_argument('--replay-speed', type=float, default=1, help='times real time to replay at, 0 for flat out')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+    diagnostics.level = args.log_level
+    diagnostics.profile_dir = args.profile_dir
+    diagnostics.interval = args.profile_interval
 
     from dbus.mainloop.glib import DBusGMainLoop
     # Have a mainloop, so we can send/receive asynchronous calls to and from dbus
     DBusGMainLoop(set_as_default=True)
-    client = ModbusTcpClient('192.168.20.23')
-    client.connect()
-
-    inverter = SungrowInverter(
-        client,
-        servicename='com.victronenergy.pvinverter.sungrow01',
-        deviceinstance=0,
-    )
-    meter = SungrowMeter(
-        client,
-        servicename='com.victronenergy.grid.sungrow01',
-        deviceinstance=0,
-    )
-
-
-    #o2 = SungrowInverter(
-	#servicename='com.victronenergy.dummyservice2.tty02',
-    #    deviceinstance=1,
-    ##    paths={
-     #       '/Ac/Energy/Forward': {'initial': 0, 'update': 1},
-    #        '/Position': {'initial': 0, 'update': 0},
-    #        '/Nonupdatingvalue/UseForTestingWritesForExample': {'initial': None},
-    #        '/DbusInvalid': {'initial': None}
-    #   	})
+
+    # Don't let a replay overwrite the real energy counters
+    state_dir = None if args.replay else args.state_dir
+    groups = start_devices(load_devices(args), args.interval, args.workers, not args.sync_io, state_dir,
+                           args.record, args.record_size, bool(args.replay),
+                           args.min_interval if args.adaptive else None, args.discover, args.history,
+                           args.processes)
+    supervisor = None
+    if args.processes and not args.replay:
+        groups, supervisor = groups
+    if args.perf_textfile:
+        GLib.timeout_add(PERF_INTERVAL*1000, write_textfile, args.perf_textfile, groups)
 
     logging.info('Connected to dbus, and switching over to GLib.MainLoop() (= event based)')
     mainloop = GLib.MainLoop()
+    if args.replay:
+        recordings = [os.path.join(args.replay, recording_name(g.name)) for g in groups]
+        missing = [r for r in recordings if not os.path.exists(r)]
+        if missing:
+            raise SystemExit(f'No recording {", ".join(missing)}')
+        Replayer(groups, recordings, args.replay_speed, mainloop.quit).start()
+    # svc -d sends SIGTERM - stop cleanly so the energy counters get saved
+    signal.signal(signal.SIGTERM, lambda *args: mainloop.quit())
+    signal.signal(signal.SIGUSR1, lambda *args: GLib.idle_add(lambda: diagnostics.set_profiling(not diagnostics.profiling)))
+    signal.signal(signal.SIGUSR2, lambda *args: GLib.idle_add(diagnostics.toggle_debug))
+    if args.profile:
+        diagnostics.set_profiling(True)
     mainloop.run()
 
+    if supervisor is not None:
+        supervisor.stop()
+    for g in groups:
+        for p in g.products:
+            p.checkpoint()
+
 
 if __name__ == "__main__":
     main()
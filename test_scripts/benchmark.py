@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark sungrow-dbus.py against the simulator on the session dbus, so we can measure
+performance changes without an inverter (e.g. in CI under dbus-run-session).
+
+dbus-run-session -- python3 test_scripts/benchmark.py --devices 4 --duration 60 --latency 50
+
+Prints one JSON line with cycles per second, sample-to-dbus latency percentiles and
+CPU/RSS per device.
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+from gi.repository import GLib
+import dbus
+from dbus.mainloop.glib import DBusGMainLoop
+from pymodbus.client.sync import ModbusTcpClient
+
+sys.path.insert(0, os.path.dirname(__file__))
+import sungrow_simulator
+
+def load_service():
+    # sungrow-dbus.py isn't an importable name
+    path = os.path.join(os.path.dirname(__file__), '..', 'sungrow-dbus.py')
+    spec = importlib.util.spec_from_file_location('sungrow_dbus', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+class SessionBus(dbus.bus.BusConnection):
+    def __new__(cls):
+        return dbus.bus.BusConnection.__new__(cls, dbus.bus.BusConnection.TYPE_SESSION)
+
+def percentile(values, q):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q*len(values)))]
+
+def rss_kb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def simulate(port, faults):
+    sungrow_simulator.make_server(port=port, faults=faults).serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark sungrow-dbus against the simulator')
+    parser.add_argument('--devices', type=int, default=1, help='number of simulated inverter + meter pairs')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to run for')
+    parser.add_argument('--interval', type=int, default=1000, help='poll interval, ms')
+    parser.add_argument('--latency', type=float, default=0, help='simulator latency, ms')
+    parser.add_argument('--jitter', type=float, default=0, help='simulator jitter, ms')
+    parser.add_argument('--drop', type=float, default=0, help='simulator connection drop probability')
+    parser.add_argument('--exception', type=float, default=0, help='simulator exception probability')
+    parser.add_argument('--port', type=int, default=15020, help='first simulator port')
+    parser.add_argument('--sync-io', action='store_true', help='do modbus reads on the main loop')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    DBusGMainLoop(set_as_default=True)
+    sd = load_service()
+
+    # One simulator per device, like one dongle per inverter. They run in another process so
+    # they don't count towards our CPU and memory.
+    faults = sungrow_simulator.Faults(args.latency/1000, args.jitter/1000, args.drop, args.exception)
+    simulators = [multiprocessing.Process(target=simulate, args=(args.port + i, faults), daemon=True)
+                  for i in range(args.devices)]
+    for p in simulators:
+        p.start()
+    time.sleep(1) # let them start listening
+
+    rss0 = rss_kb()
+    latencies = [] # sample read to published on dbus, seconds
+    groups = []
+    for i in range(args.devices):
+        client = ModbusTcpClient('127.0.0.1', port=args.port + i, timeout=1)
+        inverter = sd.SungrowInverter(client, f'com.victronenergy.pvinverter.bench{i:02d}', i, bus=SessionBus())
+        meter = sd.SungrowMeter(client, f'com.victronenergy.grid.bench{i:02d}', i, bus=SessionBus())
+        group = sd.DeviceGroup(client, [inverter, meter], interval_ms=args.interval, async_io=not args.sync_io)
+
+        def publish(start, due, t, values, _publish=group._publish):
+            _publish(start, due, t, values)
+            if t is not None:
+                latencies.append(time.monotonic() - t)
+        group._publish = publish
+        groups.append(group)
+
+    cpu0 = time.process_time()
+    t0 = time.monotonic()
+    mainloop = GLib.MainLoop()
+    GLib.timeout_add(int(args.duration*1000), mainloop.quit)
+    mainloop.run()
+    elapsed = time.monotonic() - t0
+    cpu = time.process_time() - cpu0
+
+    cycles = sum(g.perf.cycles for g in groups)
+    result = {
+        'devices': args.devices,
+        'duration': round(elapsed, 1),
+        'cycles_per_sec': round(cycles/elapsed, 2),
+        'transactions': sum(g.perf.transactions_total for g in groups),
+        'timeouts': sum(g.perf.timeouts for g in groups),
+        'errors': sum(g.perf.errors for g in groups),
+        'skipped': sum(g.perf.skipped for g in groups),
+        'latency_ms': {f'p{int(q*100)}': round(percentile(latencies, q)*1000, 2) for q in (0.5, 0.9, 0.99)},
+        'cpu_pct_per_device': round(100*cpu/elapsed/args.devices, 2),
+        'rss_kb': rss_kb(),
+        'rss_kb_per_device': round((rss_kb() - rss0)/args.devices, 1),
+    }
+    print(json.dumps(result))
+
+    for p in simulators:
+        p.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+"""
+Record a few cycles from the simulator and replay them, to check a short recording replays
+every cycle - including the first, which is the only one with the identity registers in it
+until the ring's first keyframe.
+
+dbus-run-session -- python3 test_scripts/record_replay.py --cycles 6
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+from gi.repository import GLib
+from dbus.mainloop.glib import DBusGMainLoop
+from pymodbus.client.sync import ModbusTcpClient
+
+sys.path.insert(0, os.path.dirname(__file__))
+import sungrow_simulator
+from benchmark import load_service, SessionBus
+
+def simulate(port):
+    sungrow_simulator.make_server(port=port).serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description='Check a short recording replays in full')
+    parser.add_argument('--cycles', type=int, default=6, help='poll cycles to record')
+    parser.add_argument('--port', type=int, default=15030, help='simulator port')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    DBusGMainLoop(set_as_default=True)
+    sd = load_service()
+
+    simulator = multiprocessing.Process(target=simulate, args=(args.port,), daemon=True)
+    simulator.start()
+    time.sleep(1) # let it start listening
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'rec')
+        client = ModbusTcpClient('127.0.0.1', port=args.port, timeout=1)
+        inverter = sd.SungrowInverter(client, 'com.victronenergy.pvinverter.record', 0, bus=SessionBus())
+        group = sd.DeviceGroup(client, [inverter], async_io=False, timer=False, recorder=sd.Recorder(path))
+        for _ in range(args.cycles):
+            now = time.monotonic()
+            group._start(now, group.due(now))
+        group.recorder.close()
+        recorded = group.perf.cycles
+
+        client = sd.ReplayClient('replay')
+        inverter = sd.SungrowInverter(client, 'com.victronenergy.pvinverter.replay', 1, bus=SessionBus())
+        group = sd.DeviceGroup(client, [inverter], async_io=False, timer=False)
+        mainloop = GLib.MainLoop()
+        replayer = sd.Replayer([group], [path], 0, mainloop.quit)
+        replayer.start()
+        mainloop.run()
+
+    simulator.terminate()
+    serial = inverter._dbusservice['/Serial']
+    print(f'recorded {recorded} cycles, replayed {replayer.cycles}, published {group.perf.cycles}, serial {serial!r}')
+    if not recorded == replayer.cycles == group.perf.cycles == args.cycles or not serial:
+        sys.exit('short recording didn\'t replay in full')
+
+
+if __name__ == "__main__":
+    main()
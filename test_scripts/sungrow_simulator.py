@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+
+"""
+A stand-in for a Sungrow SG inverter (with internal meter) behind a WiNet dongle, so we can run
+sungrow-dbus.py and the benchmark without the real thing.
+
+Serves the input and holding registers that sungrow-dbus.py uses, with values that change over
+time like a sunny-ish day, and can inject latency, jitter, dropped connections and modbus
+exception responses to see how the service copes.
+
+python test_scripts/sungrow_simulator.py --port 5020 --latency 50 --jitter 30 --drop 0.01
+
+It can also answer RTU frames on a pty, like an inverter on the RS485 port, or over TCP like a
+serial to ethernet converter:
+
+python test_scripts/sungrow_simulator.py --rtu-pty
+python test_scripts/sungrow_simulator.py --rtu-tcp --port 5021
+"""
+import argparse
+import logging
+import math
+import os
+import random
+import socketserver
+import struct
+import threading
+import time
+import tty
+
+from pymodbus.server.sync import ModbusTcpServer, ModbusConnectedRequestHandler
+from pymodbus.datastore import ModbusSlaveContext, ModbusServerContext
+from pymodbus.datastore.store import BaseModbusDataBlock, ModbusSequentialDataBlock
+from pymodbus.pdu import ModbusExceptions
+
+log = logging.getLogger(__name__)
+
+# Registers we answer for. Anything outside these is an illegal address, like the real thing.
+INPUT_RANGES = [(4990, 5050), (5083, 5130)]
+HOLDING_RANGES = [(5000, 5050)]
+
+def u32(v):
+    # Sungrow puts the low word first
+    v &= 0xffffffff
+    return [v & 0xffff, v >> 16]
+
+class SungrowModel:
+    '''
+    Generates register values for a 3 phase inverter and its grid meter at a given time.
+    speed > 1 runs the day faster than real time.
+    '''
+    def __init__(self, rated_power=5000, serial='SIM0000001', type_code=0x0e0d, speed=1.0):
+        self.rated_power = rated_power
+        self.serial = serial
+        self.type_code = type_code
+        self.speed = speed
+        self._t0 = time.monotonic()
+        self._last = self._t0
+        self.total_yield = 1000.0 # kWh
+        self.exported = 500.0 # kWh
+        self.imported = 800.0 # kWh
+        self.power_limit = 1000 # holding 5039, 0.1kW units
+        self._lock = threading.Lock()
+
+    def day_fraction(self, t):
+        # Start the simulated day at 6am so there's something to see
+        return ((t - self._t0)*self.speed/86400 + 0.25) % 1
+
+    def pv_power(self, t):
+        d = self.day_fraction(t)
+        sun = max(0.0, math.sin(math.pi*(d - 0.25)*2)) # up at 6am, down at 6pm
+        clouds = 0.75 + 0.25*math.sin(t*0.05) + random.uniform(-0.05, 0.05)
+        limit = self.power_limit*100
+        return min(self.rated_power*sun*max(clouds, 0), limit)
+
+    def load_power(self, t):
+        return 400 + 300*math.sin(t*0.01)**2 + random.uniform(-20, 20)
+
+    def input_registers(self):
+        t = time.monotonic()
+        with self._lock:
+            dt = (t - self._last)*self.speed/3600 # hours
+            self._last = t
+            pv = self.pv_power(t)
+            load = self.load_power(t)
+            grid = load - pv # +ve import
+            self.total_yield += pv*dt/1000
+            if grid > 0:
+                self.imported += grid*dt/1000
+            else:
+                self.exported += -grid*dt/1000
+
+        regs = {}
+        text = self.serial.encode().ljust(20, b'\0')
+        for i in range(10):
+            regs[4990 + i] = text[2*i] << 8 | text[2*i + 1]
+        regs[5000] = self.type_code
+        regs[5001] = self.rated_power//100
+        regs[5004], regs[5005] = u32(int(self.total_yield))
+        for phase in range(3):
+            v = 2400 + random.randint(-30, 30) # 0.1V
+            regs[5019 + phase] = v
+            regs[5022 + phase] = int(pv/3/(v/10)*10) # 0.1A
+        regs[5031], regs[5032] = u32(int(pv))
+        regs[5038] = 0 if pv > 0 else 0x1400 # running / standby
+        regs[5083], regs[5084] = u32(int(grid))
+        for phase in range(3):
+            regs[5085 + 2*phase], regs[5086 + 2*phase] = u32(int(grid/3))
+        regs[5095], regs[5096] = u32(int(self.exported*10))
+        regs[5099], regs[5100] = u32(int(self.imported*10))
+        return regs
+
+class InputBlock(BaseModbusDataBlock):
+    '''
+    Computes the input registers on each read from the model
+    '''
+    def __init__(self, model):
+        self.model = model
+        self.address = INPUT_RANGES[0][0]
+        self.default_value = 0
+        self.values = {}
+
+    def validate(self, address, count=1):
+        return any(lo <= address and address + count <= hi for lo, hi in INPUT_RANGES)
+
+    def getValues(self, address, count=1):
+        regs = self.model.input_registers()
+        return [regs.get(a, 0) for a in range(address, address + count)]
+
+    def setValues(self, address, values):
+        pass
+
+class HoldingBlock(ModbusSequentialDataBlock):
+    def __init__(self, model):
+        lo, hi = HOLDING_RANGES[0]
+        super().__init__(lo, [0]*(hi - lo))
+        self.model = model
+        self.values[5039 - lo] = model.power_limit
+
+    def setValues(self, address, values):
+        super().setValues(address, values)
+        if address <= 5039 < address + len(values):
+            self.model.power_limit = values[5039 - address]
+
+class Faults:
+    '''
+    What to do to each request. latency and jitter are seconds, drop and exception are probabilities.
+    '''
+    def __init__(self, latency=0.0, jitter=0.0, drop=0.0, exception=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.drop = drop
+        self.exception = exception
+        self.requests = 0
+        self.dropped = 0
+        self.exceptions = 0
+
+class FaultyHandler(ModbusConnectedRequestHandler):
+    def execute(self, request):
+        faults = self.server.faults
+        faults.requests += 1
+        delay = faults.latency + random.uniform(0, faults.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        if random.random() < faults.drop:
+            faults.dropped += 1
+            log.info('Dropping connection')
+            self.running = False
+            self.request.close()
+            return
+
+        if random.random() < faults.exception:
+            faults.exceptions += 1
+            response = request.doException(ModbusExceptions.SlaveBusy)
+            response.transaction_id = request.transaction_id
+            response.unit_id = request.unit_id
+            self.send(response)
+            return
+
+        super().execute(request)
+
+def crc16(data):
+    crc = 0xffff
+    for b in data:
+        crc ^= b
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xa001 if crc & 1 else crc >> 1
+    return crc
+
+class RtuResponder:
+    '''
+    Answers modbus RTU requests from the model, over any byte stream. Only handles one
+    request at a time, like a real RS485 slave.
+    '''
+    def __init__(self, model, faults=None, unit=1):
+        self.model = model
+        self.faults = faults or Faults()
+        self.unit = unit
+        self.input = InputBlock(model)
+        self.holding = HoldingBlock(model)
+
+    def respond(self, frame):
+        unit, fc = frame[0], frame[1]
+        if unit != self.unit:
+            return None # someone else on the bus
+        if fc in (3, 4):
+            address, count = struct.unpack('>HH', frame[2:6])
+            address += 1
+            block = self.input if fc == 4 else self.holding
+            if not block.validate(address, count):
+                return self._frame(unit, bytes([fc | 0x80, ModbusExceptions.IllegalAddress]))
+            return self._frame(unit, struct.pack(f'>BB{count}H', fc, 2*count, *block.getValues(address, count)))
+        if fc == 6:
+            address, value = struct.unpack('>HH', frame[2:6])
+            self.holding.setValues(address + 1, [value])
+            return self._frame(unit, frame[1:6])
+        if fc == 16:
+            address, count = struct.unpack('>HH', frame[2:6])
+            self.holding.setValues(address + 1, list(struct.unpack(f'>{count}H', frame[7:7 + 2*count])))
+            return self._frame(unit, frame[1:6])
+        return self._frame(unit, bytes([fc | 0x80, ModbusExceptions.IllegalFunction]))
+
+    def _frame(self, unit, pdu):
+        frame = bytes([unit]) + pdu
+        return frame + struct.pack('<H', crc16(frame))
+
+    def serve(self, read, write):
+        '''read(n) returns up to n bytes, b'' at the end'''
+        buffer = b''
+        while True:
+            data = read(256)
+            if not data:
+                return
+            buffer += data
+            while len(buffer) >= 8:
+                # Requests we answer are 8 bytes, apart from write multiple
+                n = 9 + buffer[6] if buffer[1] == 16 else 8
+                if len(buffer) < n:
+                    break
+                frame, buffer = buffer[:n], buffer[n:]
+                if crc16(frame[:-2]) != struct.unpack('<H', frame[-2:])[0]:
+                    log.info('Bad CRC, dropping %d bytes', len(frame) + len(buffer))
+                    buffer = b''
+                    break
+                faults = self.faults
+                faults.requests += 1
+                delay = faults.latency + random.uniform(0, faults.jitter)
+                if delay > 0:
+                    time.sleep(delay)
+                if random.random() < faults.drop:
+                    faults.dropped += 1
+                    continue # no answer, the master times out
+                if random.random() < faults.exception:
+                    faults.exceptions += 1
+                    write(self._frame(frame[0], bytes([frame[1] | 0x80, ModbusExceptions.SlaveBusy])))
+                    continue
+                response = self.respond(frame)
+                if response is not None:
+                    write(response)
+
+def start_rtu_pty(model=None, faults=None):
+    '''
+    Serve RTU on a new pty in a background thread. Returns the path of the end to open as the
+    serial port.
+    '''
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    responder = RtuResponder(model or SungrowModel(), faults)
+    threading.Thread(target=responder.serve, args=(lambda n: os.read(master, n), lambda b: os.write(master, b)),
+                     name='rtu', daemon=True).start()
+    return os.ttyname(slave)
+
+def make_rtu_tcp_server(host='127.0.0.1', port=5021, model=None, faults=None):
+    '''RTU frames over TCP, like a serial to ethernet converter'''
+    responder = RtuResponder(model or SungrowModel(), faults)
+
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            responder.serve(self.request.recv, self.request.sendall)
+
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    server = socketserver.ThreadingTCPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.model = responder.model
+    server.faults = responder.faults
+    return server
+
+def make_server(host='127.0.0.1', port=5020, model=None, faults=None):
+    model = model or SungrowModel()
+    store = ModbusSlaveContext(ir=InputBlock(model), hr=HoldingBlock(model))
+    context = ModbusServerContext(slaves=store, single=True)
+    server = ModbusTcpServer(context, handler=FaultyHandler, address=(host, port), allow_reuse_address=True)
+    server.model = model
+    server.faults = faults or Faults()
+    return server
+
+def start(host='127.0.0.1', port=5020, model=None, faults=None):
+    '''
+    Run a simulator in a background thread. Returns the server - call server.shutdown() to stop it.
+    '''
+    server = make_server(host, port, model, faults)
+    threading.Thread(target=server.serve_forever, name='simulator', daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description='Sungrow modbus TCP simulator')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5020)
+    parser.add_argument('--latency', type=float, default=0, help='ms added to every request')
+    parser.add_argument('--jitter', type=float, default=0, help='up to this many more ms, uniformly distributed')
+    parser.add_argument('--drop', type=float, default=0, help='probability of dropping the connection on a request')
+    parser.add_argument('--exception', type=float, default=0, help='probability of answering with an exception')
+    parser.add_argument('--speed', type=float, default=1, help='run the simulated day this many times faster')
+    parser.add_argument('--rtu-pty', action='store_true', help='answer RTU on a pty instead of modbus TCP')
+    parser.add_argument('--rtu-tcp', action='store_true', help='answer RTU frames over TCP instead of modbus TCP')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    faults = Faults(args.latency/1000, args.jitter/1000, args.drop, args.exception)
+    model = SungrowModel(speed=args.speed)
+    if args.rtu_pty:
+        log.info('Serving RTU on %s', start_rtu_pty(model, faults))
+        threading.Event().wait()
+    if args.rtu_tcp:
+        server = make_rtu_tcp_server(args.host, args.port, model, faults)
+    else:
+        server = make_server(args.host, args.port, model, faults)
+    log.info('Serving on %s:%d', args.host, args.port)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()